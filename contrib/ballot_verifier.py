@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+
+# Verification of ballots in Python, used by monitor_elections.py (with
+# --python-verify) to check only the ballots that were added since the
+# previous run, instead of running belenios-tool on all of them.
+#
+# The checks are the ones of Election.check_ballot (src/lib/election.ml):
+# the ballot is for this election, its signature is valid, and so are
+# the proofs of each of its answers (Question_h.verify_answer and
+# Question_nh.verify_answer). Only finite field groups are supported, as
+# in Group_field.
+#
+# The hashes of the ballots that passed these checks are kept, with the
+# credential used to sign them, in an SQLite file, so that they are not
+# checked again. The checks are spread over a pool of processes.
+#
+# If gmpy2 is installed, it is used for modular arithmetic, which is
+# much faster than with Python integers.
+#
+# Usage (to check ballots by hand):
+#   ./ballot_verifier.py election.json ballots.jsons
+#   ./ballot_verifier.py --cache /tmp/verified.sqlite --jobs 8 election.json ballots.jsons
+
+import argparse
+import os
+import sys
+import json
+import re
+import base64
+import hashlib
+import sqlite3
+import concurrent.futures
+
+try:
+    import gmpy2
+    mpz = gmpy2.mpz
+    powmod = gmpy2.powmod
+    def invert(x, p):
+        return gmpy2.invert(x, p)
+except ImportError:
+    gmpy2 = None
+    mpz = int
+    powmod = pow
+    def invert(x, p):
+        return pow(x, -1, p)
+
+# Same as sha256_b64 of the OCaml code (base64 without padding)
+def sha256_b64(x):
+    return base64.b64encode(hashlib.sha256(x).digest()).decode().strip('=')
+
+class Group:
+    def __init__(self, params):
+        self.p = mpz(int(params['p']))
+        self.q = mpz(int(params['q']))
+        self.g = mpz(int(params['g']))
+        self.invg = invert(self.g, self.p)
+
+    def check(self, x):
+        return 0 <= x < self.p and powmod(x, self.q, self.p) == 1
+
+    def check_modulo(self, x):
+        return 0 <= x < self.q
+
+    def mul(self, *xs):
+        r = mpz(1)
+        for x in xs:
+            r = r * x % self.p
+        return r
+
+    def pow(self, x, e):
+        return powmod(x, e, self.p)
+
+    def div(self, x, y):
+        return x * invert(y, self.p) % self.p
+
+    # G.hash: hash of the prefix followed by the elements, reduced mod q
+    def hash(self, prefix, xs):
+        s = prefix + ",".join(str(x) for x in xs)
+        return mpz(int(hashlib.sha256(s.encode()).hexdigest(), 16)) % self.q
+
+# Group elements and numbers are serialized as JSON strings
+# Numbers are strings of decimal digits: int() alone would also accept
+# signs, spaces and underscores
+def num(x):
+    if not isinstance(x, str) or re.fullmatch("[0-9]+", x) == None:
+        raise ValueError("a string of decimal digits was expected")
+    return mpz(int(x))
+
+def proof(x):
+    return num(x['challenge']), num(x['response'])
+
+def ciphertext(x):
+    return num(x['alpha']), num(x['beta'])
+
+class Election:
+    # raw: content of election.json
+    def __init__(self, raw):
+        if raw.endswith(b'\n'):
+            raw = raw[0:-1]
+        self.fingerprint = sha256_b64(raw)
+        params = json.loads(raw)
+        self.uuid = params['uuid']
+        self.group = Group(params['public_key']['group'])
+        self.y = num(params['public_key']['y'])
+        self.questions = params['questions']
+
+    # Proof that alpha = g^r and beta = y^r/d_x for some x (eg_disj_verify)
+    def disj_verify(self, d, zkp, proofs, c):
+        G = self.group
+        y = self.y
+        alpha, beta = c
+        if not (G.check(alpha) and G.check(beta)):
+            return False
+        proofs = [ proof(x) for x in proofs ]
+        if len(d) != len(proofs):
+            return False
+        commitments = []
+        total = mpz(0)
+        for di, (challenge, response) in zip(d, proofs):
+            if not (G.check_modulo(challenge) and G.check_modulo(response)):
+                return False
+            commitments.append(G.div(G.pow(G.g, response),
+                G.pow(alpha, challenge)))
+            commitments.append(G.div(G.pow(y, response),
+                G.pow(G.mul(beta, di), challenge)))
+            total += challenge
+        prefix = "prove|{}|{},{}|".format(zkp, alpha, beta)
+        return G.hash(prefix, commitments) == total % G.q
+
+    def make_d(self, qmin, qmax):
+        G = self.group
+        gmin = mpz(1) if qmin == 0 else G.pow(G.g, qmin)
+        d = [ invert(gmin, G.p) ]
+        for i in range(1, qmax - qmin + 1):
+            d.append(G.mul(d[-1], G.invg))
+        return d
+
+    # verify_blank_proof of Question_h
+    def blank_verify(self, zkp, qmin, qmax, c0, cS, overall_proof, blank_proof):
+        G = self.group
+        y = self.y
+        if not all(G.check(x) for x in c0 + cS):
+            return False
+        zkp = "{}|{},{},{},{},{},{}".format(zkp, G.g, y, c0[0], c0[1],
+                cS[0], cS[1])
+        blank_proof = [ proof(x) for x in blank_proof ]
+        if len(blank_proof) != 2:
+            return False
+        commitments = []
+        total = mpz(0)
+        for (challenge, response), (alpha, beta) in zip(blank_proof, [c0, cS]):
+            if not (G.check_modulo(challenge) and G.check_modulo(response)):
+                return False
+            commitments.append(G.mul(G.pow(G.g, response), G.pow(alpha, challenge)))
+            commitments.append(G.mul(G.pow(y, response), G.pow(beta, challenge)))
+            total += challenge
+        if G.hash("bproof0|{}|".format(zkp), commitments) != total % G.q:
+            return False
+        overall_proof = [ proof(x) for x in overall_proof ]
+        if len(overall_proof) != qmax - qmin + 2:
+            return False
+        commitments = []
+        total = mpz(0)
+        for i, (challenge, response) in enumerate(overall_proof):
+            if not (G.check_modulo(challenge) and G.check_modulo(response)):
+                return False
+            if i == 0:
+                alpha, beta = c0[0], G.div(c0[1], G.g)
+            else:
+                m = qmin + i - 1
+                gm = mpz(1) if m == 0 else G.pow(G.g, m)
+                alpha, beta = cS[0], G.div(cS[1], gm)
+            commitments.append(G.mul(G.pow(G.g, response), G.pow(alpha, challenge)))
+            commitments.append(G.mul(G.pow(y, response), G.pow(beta, challenge)))
+            total += challenge
+        return G.hash("bproof1|{}|".format(zkp), commitments) == total % G.q
+
+    def verify_answer(self, question, zkp, a):
+        G = self.group
+        if question.get('type') == 'NonHomomorphic':
+            alpha, beta = ciphertext(a['choices'])
+            challenge, response = proof(a['proof'])
+            if not (G.check(alpha) and G.check(beta) and
+                    G.check_modulo(challenge) and G.check_modulo(response)):
+                return False
+            commitment = G.mul(G.pow(G.g, response), G.pow(alpha, challenge))
+            prefix = "raweg|{}|{},{},{}|".format(zkp, self.y, alpha, beta)
+            return challenge == G.hash(prefix, [commitment])
+        choices = [ ciphertext(x) for x in a['choices'] ]
+        n = len(choices)
+        if n != len(a['individual_proofs']):
+            return False
+        d01 = [ mpz(1), G.invg ]
+        for p, c in zip(a['individual_proofs'], choices):
+            if not self.disj_verify(d01, zkp, p, c):
+                return False
+        qmin = question['min']
+        qmax = question['max']
+        blank_proof = a.get('blank_proof')
+        if blank_proof == None:
+            if n != len(question['answers']):
+                return False
+            sumc = (G.mul(*(c[0] for c in choices)),
+                    G.mul(*(c[1] for c in choices)))
+            return self.disj_verify(self.make_d(qmin, qmax), zkp,
+                    a['overall_proof'], sumc)
+        if question.get('blank') != True or n != len(question['answers']) + 1:
+            return False
+        sumc = (G.mul(*(c[0] for c in choices[1:])),
+                G.mul(*(c[1] for c in choices[1:])))
+        return self.blank_verify(zkp, qmin, qmax, choices[0], sumc,
+                a['overall_proof'], blank_proof)
+
+    # Ciphertexts signed by the credential (make_sig_contents)
+    def sig_contents(self, answers):
+        contents = []
+        for question, a in zip(self.questions, answers):
+            if question.get('type') == 'NonHomomorphic':
+                contents += ciphertext(a['choices'])
+            else:
+                for c in a['choices']:
+                    contents += ciphertext(c)
+        return contents
+
+    # Check a ballot (a line of ballots.jsons); return whether it is
+    # valid, and its credential (None if it is not signed).
+    def check_ballot(self, line):
+        G = self.group
+        try:
+            b = json.loads(line)
+            if (b['election_uuid'] != self.uuid or
+                    b['election_hash'] != self.fingerprint):
+                return False, None
+            answers = b['answers']
+            if len(answers) != len(self.questions):
+                return False, None
+            zkp = ""
+            credential = None
+            if b.get('signature') != None:
+                s = b['signature']
+                credential = num(s['public_key'])
+                challenge, response = proof(s)
+                if not (G.check(credential) and G.check_modulo(challenge)
+                        and G.check_modulo(response)):
+                    return False, None
+                zkp = str(credential)
+                commitment = G.mul(G.pow(G.g, response),
+                        G.pow(credential, challenge))
+                prefix = "sig|{}|{}|".format(zkp, commitment)
+                if challenge != G.hash(prefix, self.sig_contents(answers)):
+                    return False, None
+                credential = str(credential)
+            for question, a in zip(self.questions, answers):
+                if not self.verify_answer(question, zkp, a):
+                    return False, None
+            return True, credential
+        except (ValueError, KeyError, TypeError, IndexError,
+                AttributeError, ZeroDivisionError):
+            return False, None
+
+# Credential of a ballot, without any check
+def ballot_credential(line):
+    b = json.loads(line)
+    if b.get('signature') == None:
+        return None
+    return str(int(b['signature']['public_key']))
+
+# Hashes of the ballots already verified (for a given election), with
+# their credentials
+class VerifiedCache:
+    def __init__(self, path, fingerprint):
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS verified (hash TEXT PRIMARY KEY, credential TEXT)")
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'election'").fetchone()
+        if row == None or row[0] != fingerprint:
+            self.db.execute("DELETE FROM verified")
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('election', ?)",
+                    (fingerprint,))
+        self.db.commit()
+
+    # Dict from the hashes that are in the cache to their credentials
+    def lookup(self, hashes):
+        res = {}
+        self.db.execute("CREATE TEMP TABLE IF NOT EXISTS wanted (hash TEXT)")
+        self.db.execute("DELETE FROM wanted")
+        self.db.executemany("INSERT INTO wanted VALUES (?)",
+                ( (h,) for h in hashes ))
+        for h, cred in self.db.execute("SELECT verified.hash, credential FROM verified JOIN wanted ON verified.hash = wanted.hash"):
+            res[h] = cred
+        return res
+
+    # items: list of (hash, credential)
+    def add(self, items):
+        self.db.executemany("INSERT OR REPLACE INTO verified VALUES (?, ?)",
+                items)
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+worker_election = None
+
+def init_worker(raw):
+    global worker_election
+    worker_election = Election(raw)
+
+def check_chunk(lines):
+    return [ worker_election.check_ballot(l) for l in lines ]
+
+# Pool of jobs processes checking the ballots of the election whose
+# election.json is raw, to be reused by several calls of check_ballots
+def make_pool(raw, jobs):
+    return concurrent.futures.ProcessPoolExecutor(jobs,
+            initializer=init_worker, initargs=(raw,))
+
+# Check lines (ballots) of the election whose election.json is raw;
+# return the list of (valid, credential). Unless jobs is 1, they are
+# split among a pool of jobs processes: procs if given (see make_pool),
+# otherwise a pool made for this call.
+def check_ballots(raw, lines, jobs=None, procs=None):
+    if jobs == None:
+        jobs = os.cpu_count() or 1
+    if jobs == 1 or len(lines) <= 1:
+        election = Election(raw)
+        return [ election.check_ballot(l) for l in lines ]
+    # small chunks, so that the work is evenly spread
+    chunk_size = max(1, min(16, len(lines) // (4 * jobs)))
+    chunks = [ lines[i:i+chunk_size] for i in range(0, len(lines), chunk_size) ]
+    if procs == None:
+        with make_pool(raw, min(jobs, len(chunks))) as procs:
+            return check_ballots(raw, lines, jobs, procs)
+    res = []
+    for r in procs.map(check_chunk, chunks):
+        res += r
+    return res
+
+# Check the ballots (lines) that are not in cache (if not None); return
+# the list of the credentials of all the ballots (None for those that
+# are invalid or not signed), and the number of ballots that were
+# checked. procs is passed to check_ballots.
+def verify_ballots(raw, lines, cache=None, jobs=None, procs=None):
+    hashes = [ sha256_b64(l) for l in lines ]
+    known = cache.lookup(hashes) if cache != None else {}
+    todo = [ i for i, h in enumerate(hashes) if h not in known ]
+    res = check_ballots(raw, [ lines[i] for i in todo ], jobs, procs)
+    creds = [ known.get(h) for h in hashes ]
+    new = []
+    for i, (ok, cred) in zip(todo, res):
+        if ok and cred != None:
+            creds[i] = cred
+            new.append((hashes[i], cred))
+    if cache != None:
+        cache.add(new)
+    return creds, len(todo)
+
+def main():
+    parser = argparse.ArgumentParser(description="check the signatures and proofs of ballots")
+    parser.add_argument("election", help="election.json")
+    parser.add_argument("ballots", help="ballots.jsons")
+    parser.add_argument("--cache", help="SQLite file keeping the hashes of the ballots already verified")
+    parser.add_argument("--jobs", type=int, default=None,
+            help="number of processes (default: number of cores)")
+    args = parser.parse_args()
+
+    with open(args.election, "rb") as file:
+        raw = file.read()
+    with open(args.ballots, "rb") as file:
+        lines = file.read().splitlines()
+    cache = None
+    if args.cache != None:
+        cache = VerifiedCache(args.cache, Election(raw).fingerprint)
+    creds, n = verify_ballots(raw, lines, cache, args.jobs)
+    fail = False
+    for l, cred in zip(lines, creds):
+        # unsigned ballots are accepted by check_ballot, but not by
+        # belenios-tool verify when there are credentials
+        if cred == None:
+            print("ballot {} failed tests".format(sha256_b64(l)))
+            fail = True
+    print("{} ballot(s), {} checked{}".format(len(lines), n,
+        "" if gmpy2 != None else " (without gmpy2)"), file=sys.stderr)
+    sys.exit(1 if fail else 0)
+
+if __name__ == "__main__":
+    main()
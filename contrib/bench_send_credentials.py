@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+
+# Throughput benchmark of send_credentials.py, without a real relay: a
+# local SMTP sink is started in this process, a code file of synthetic
+# voters is generated, and the messages are sent to the sink by the
+# delivery engine of send_credentials.py, with the same parameters.
+#
+# The sink emulates a relay: STARTTLS (with a self-signed certificate
+# made by openssl), AUTH PLAIN and LOGIN (any password is accepted), an
+# artificial delay before accepting each message, and temporary errors
+# (a 4xx reply to RCPT) for a given fraction of the messages.
+#
+# Example: 10000 voters, 8 sessions, no rate limit, 20ms of latency and
+# 1% of temporary errors:
+#   ./bench_send_credentials.py --voters 10000 --connections 8 --rate 0 --latency 0.02 --fail-rate 0.01
+#
+# With --spool-format, the messages are rendered in a spool first (see
+# --render in send_credentials.py), and only sending it is measured.
+
+# External dependencies:
+# - send_credentials.py  (from the belenios source dist, in contrib/)
+# - openssl  (unless --cert and --key are given)
+
+import argparse
+import os
+import sys
+import ssl
+import time
+import random
+import base64
+import tempfile
+import threading
+import subprocess
+import socketserver
+import send_credentials
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, context, latency=0, fail_rate=0,
+            fail_code=451):
+        super().__init__(address, SMTPSession)
+        self.context = context
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.fail_code = fail_code
+        self.lock = threading.Lock()
+        self.sessions = 0
+        self.injected = 0
+        # recipient -> number of messages received
+        self.received = {}
+
+class SMTPSession(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write((line + "\r\n").encode())
+
+    def readline(self):
+        return self.rfile.readline().decode(errors="replace").rstrip("\r\n")
+
+    def handle(self):
+        sink = self.server
+        with sink.lock:
+            sink.sessions += 1
+        tls = False
+        authenticated = False
+        rcpts = []
+        self.reply("220 sink ESMTP")
+        while True:
+            line = self.readline()
+            if line == "":
+                return
+            verb = line.split(" ", 1)[0].upper()
+            arg = line[len(verb):].strip()
+            if verb in ("EHLO", "HELO"):
+                ext = ["AUTH PLAIN LOGIN"] if tls else ["STARTTLS"]
+                for e in ["sink", "8BITMIME"] + ext[:-1]:
+                    self.reply("250-" + e)
+                self.reply("250 " + ext[-1])
+            elif verb == "STARTTLS" and not tls:
+                self.reply("220 Ready to start TLS")
+                self.connection = sink.context.wrap_socket(self.connection,
+                        server_side=True)
+                self.rfile = self.connection.makefile("rb")
+                self.wfile = self.connection.makefile("wb", buffering=0)
+                tls = True
+            elif verb == "AUTH" and tls:
+                mech = arg.split(" ")
+                if mech[0].upper() == "PLAIN":
+                    if len(mech) == 1:
+                        self.reply("334 ")
+                        self.readline()
+                elif mech[0].upper() == "LOGIN":
+                    for prompt in (b"Username:", b"Password:"):
+                        self.reply("334 " + base64.b64encode(prompt).decode())
+                        self.readline()
+                else:
+                    self.reply("504 Unrecognized authentication type")
+                    continue
+                authenticated = True
+                self.reply("235 Authentication successful")
+            elif verb in ("MAIL", "RCPT", "DATA") and not authenticated:
+                self.reply("530 Authentication required")
+            elif verb == "MAIL":
+                rcpts = []
+                self.reply("250 OK")
+            elif verb == "RCPT":
+                if random.random() < sink.fail_rate:
+                    with sink.lock:
+                        sink.injected += 1
+                    self.reply("{} Try again later".format(sink.fail_code))
+                else:
+                    rcpts.append(arg.split(":", 1)[-1].strip("<> "))
+                    self.reply("250 OK")
+            elif verb == "DATA":
+                if rcpts == []:
+                    self.reply("503 No valid recipients")
+                    continue
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                while True:
+                    l = self.rfile.readline()
+                    if l == b".\r\n" or l == b"":
+                        break
+                time.sleep(sink.latency)
+                with sink.lock:
+                    for r in rcpts:
+                        sink.received[r] = sink.received.get(r, 0) + 1
+                rcpts = []
+                self.reply("250 OK: queued")
+            elif verb == "RSET":
+                rcpts = []
+                self.reply("250 OK")
+            elif verb == "QUIT":
+                self.reply("221 Bye")
+                return
+            elif verb == "NOOP":
+                self.reply("250 OK")
+            else:
+                self.reply("502 Command not implemented")
+
+def make_certificate(d):
+    cert = os.path.join(d, "cert.pem")
+    key = os.path.join(d, "key.pem")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048",
+        "-nodes", "-days", "1", "-subj", "/CN=localhost",
+        "-keyout", key, "-out", cert], check=True,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return cert, key
+
+def write_code_file(path, n):
+    with open(path, "w") as file:
+        for i in range(n):
+            code = base64.b32encode(os.urandom(10)).decode().lower()
+            file.write("voter{}@example.com,1 {}\n".format(i, code))
+
+def percentile(values, p):
+    if values == []:
+        return 0
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+def main():
+    parser = argparse.ArgumentParser(description="measure the throughput of send_credentials.py against a local SMTP sink")
+    parser.add_argument("--voters", type=int, default=1000, metavar="N",
+            help="number of messages to send (default: 1000)")
+    parser.add_argument("--connections", type=int,
+            default=send_credentials.CONNECTIONS, metavar="N",
+            help="number of simultaneous SMTP sessions (default: {})".format(send_credentials.CONNECTIONS))
+    parser.add_argument("--rate", type=float, default=0, metavar="N",
+            help="maximum number of messages per second (default: 0, no limit)")
+    parser.add_argument("--rate-per-connection", type=float, default=0,
+            metavar="N", help="maximum number of messages per second and per session (default: 0, no limit)")
+    parser.add_argument("--latency", type=float, default=0, metavar="SECONDS",
+            help="delay of the sink before accepting each message")
+    parser.add_argument("--fail-rate", type=float, default=0, metavar="P",
+            help="fraction of the recipients refused with a temporary error")
+    parser.add_argument("--fail-code", type=int, default=451, metavar="CODE",
+            help="reply code of these errors (default: 451)")
+    parser.add_argument("--backoff-min", type=float,
+            default=send_credentials.BACKOFF_MIN, metavar="SECONDS",
+            help="first delay before reconnecting after a temporary error (default: {})".format(send_credentials.BACKOFF_MIN))
+    parser.add_argument("--spool-format", choices=['maildir', 'mbox'],
+            help="render the messages in a spool of this format first, and only measure sending it")
+    parser.add_argument("--cert", help="certificate of the sink, in PEM format")
+    parser.add_argument("--key", help="private key of the sink, in PEM format")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as d:
+        if args.cert and args.key:
+            cert, key = args.cert, args.key
+        else:
+            cert, key = make_certificate(d)
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert, key)
+        sink = SMTPSink(("127.0.0.1", 0), context, args.latency,
+                args.fail_rate, args.fail_code)
+        threading.Thread(target=sink.serve_forever, daemon=True).start()
+
+        code_file = os.path.join(d, "codes.txt")
+        write_code_file(code_file, args.voters)
+        codes = send_credentials.read_codes(code_file)
+        send = send_credentials.send_code
+        if args.spool_format:
+            spool = os.path.join(d, "spool")
+            start = time.monotonic()
+            send_credentials.render_spool(codes, spool, args.spool_format,
+                    os.cpu_count())
+            print("Rendered {} message(s) in {:.2f}s".format(len(codes),
+                time.monotonic() - start))
+            box = send_credentials.open_spool(spool, args.spool_format)
+            codes = send_credentials.read_spool(box)
+            send = send_credentials.spool_sender(box)
+
+        # time of each attempt to send a message, its outcome, and the
+        # key of the message
+        attempts = []
+        lock = threading.Lock()
+        def timed_send(s, item):
+            start = time.monotonic()
+            ok = False
+            try:
+                send(s, item)
+                ok = True
+            finally:
+                with lock:
+                    attempts.append((time.monotonic() - start, ok, item[0]))
+
+        config = argparse.Namespace(smtp="127.0.0.1:{}".format(sink.server_address[1]),
+                username="bench", connections=args.connections,
+                rate=args.rate or None,
+                rate_per_connection=args.rate_per_connection or None)
+        send_credentials.BACKOFF_MIN = args.backoff_min
+        start = time.monotonic()
+        failed = send_credentials.deliver(codes, config, "bench", None,
+                timed_send)
+        elapsed = time.monotonic() - start
+        sink.shutdown()
+
+    sent = [ t for t, ok, key in attempts if ok ]
+    sent.sort()
+    # a failed attempt is a retry if the message was sent later, and is
+    # counted with the permanent failures otherwise
+    sent_keys = set(key for t, ok, key in attempts if ok)
+    retries = len([ key for t, ok, key in attempts
+        if not ok and key in sent_keys ])
+    print("Sent {} message(s) in {:.2f}s: {:.1f} msg/s".format(len(sent),
+        elapsed, len(sent) / elapsed if elapsed > 0 else 0))
+    print("Latency of a message (ms): p50 {:.1f}, p90 {:.1f}, p99 {:.1f}, max {:.1f}".format(
+        *[ 1000 * percentile(sent, p) for p in (50, 90, 99, 100) ]))
+    print("Retries: {} ({} error(s) injected by the sink)".format(
+        retries, sink.injected))
+    print("Failed: {} message(s), after {} attempt(s)".format(len(failed),
+        len(attempts) - len(sent) - retries))
+    duplicates = sum(n - 1 for n in sink.received.values())
+    print("SMTP sessions: {}, messages received: {}, duplicates: {}".format(
+        sink.sessions, sum(sink.received.values()), duplicates))
+    if failed != [] or duplicates != 0:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -5,70 +5,311 @@ import os
 import sys
 import hashlib
 import base64
-import urllib.request
 import json
+import urllib.error
+import concurrent.futures
+import threading
+import http_pool
 
+# Example, checking two servers, with 8 downloads at a time and a cache
+# of the validators (ETag, Last-Modified) of the files, so that files
+# that did not change since the previous run are not downloaded again:
+#   ./check_hash.py --url https://belenios.loria.fr/ --url https://vote.example.org/ --reference ref.json --jobs 8 --cache /tmp/check_hash_cache.json
+#
+# A new reference can be built without a server, from the static files
+# installed by the build (they are served under /static/): those listed
+# in --reference, or in reference_template.json. vote.html is generated
+# by the server, so its hashes are taken from a previous reference, if
+# given. With --build-cache, only the files whose size or modification
+# time changed are hashed again:
+#   ./check_hash.py --build _run/usr/share/belenios-server --reference ref.json --build-cache /tmp/build_cache.json --output new_ref.json
+#
+# Compare two references:
+#   ./check_hash.py --diff ref.json new_ref.json
 
-def hash_votefile(link, lang):
+# HTTP connections to the server (see http_pool.py), set in the main part
+pool = None
+
+# url (and language for vote.html) -> validators of the last response and
+# hash of its body; see --cache
+cache = {}
+cache_lock = threading.Lock()
+
+def cache_key(link, lang):
+    if lang == None:
+        return link
+    return "{} [{}]".format(link, lang)
+
+# Return the hash of the file at link (in language lang if not None).
+# The request is conditional on the validators of the previous response,
+# if any: on 304 Not Modified, the previous hash is returned.
+def hash_url(link, lang=None):
+    key = cache_key(link, lang)
+    head = {}
+    if lang != None:
+        head['Accept-Language'] = lang
+    with cache_lock:
+        entry = cache.get(key)
+    if entry != None:
+        if 'etag' in entry:
+            head['If-None-Match'] = entry['etag']
+        if 'last_modified' in entry:
+            head['If-Modified-Since'] = entry['last_modified']
     try:
-        head = { 'Accept-Language' : lang }
-        req = urllib.request.Request(link, headers=head)
-        resp = urllib.request.urlopen(req)
-        data = resp.read()
-    except:
-        print("Failed to download vote.html in lang {}.  Aborting".format(lang))
-        sys.exit(1)
+        resp = pool.request(link, head)
+    except urllib.error.HTTPError as e:
+        if e.code == 304 and entry != None:
+            return entry['sha256']
+        raise
     m = hashlib.sha256()
-    m.update(data)
+    m.update(resp.read())
     h = m.hexdigest()
+    entry = { 'sha256': h }
+    if resp.headers.get('ETag') != None:
+        entry['etag'] = resp.headers['ETag']
+    if resp.headers.get('Last-Modified') != None:
+        entry['last_modified'] = resp.headers['Last-Modified']
+    with cache_lock:
+        cache[key] = entry
     return h
 
+def hash_votefile(link, lang):
+    try:
+        return hash_url(link, lang)
+    except Exception:
+        print("Failed to download {} in lang {}".format(link, lang))
+        return None
+
 def hash_file(link):
     try:
-        resp = urllib.request.urlopen(link)
-        data = resp.read()
-    except:
-        print("Failed to download {}. Aborting".format(link))
-        sys.exit(1)
+        return hash_url(link)
+    except Exception:
+        print("Failed to download {}".format(link))
+        return None
+
+def load_cache(path):
+    try:
+        with open(path, "r") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+def save_cache(path, cache):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as file:
+        json.dump(cache, file)
+    os.replace(tmp, path)
+
+def sha256_of_file(path):
     m = hashlib.sha256()
-    m.update(data)
-    h = m.hexdigest()
-    return h
+    with open(path, "rb") as file:
+        while True:
+            block = file.read(1 << 20)
+            if block == b'':
+                break
+            m.update(block)
+    return m.hexdigest()
+
+# Reference for the static files of base (or, if it has none, of
+# reference_template.json) found in the directory static_dir (the share
+# directory of belenios-server), completed with the entries of base that
+# are not static files (vote.html). Other files of static_dir, such as
+# build artefacts, are not served and are ignored. build_cache maps the
+# paths of the files to their size, mtime and hash, and is updated.
+# Return the reference, the number of files hashed and the list of the
+# static files that are missing.
+TEMPLATE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        "reference_template.json")
 
+def build_reference(static_dir, base, build_cache):
+    files = [ f for f in base if f.startswith("/static/") ]
+    if files == []:
+        with open(TEMPLATE_FILE) as f:
+            files = [ f for f in json.load(f) if f.startswith("/static/") ]
+    reference = {}
+    hashed = 0
+    seen = {}
+    missing = []
+    for f in files:
+        rel = f[len("/static/"):]
+        path = os.path.join(static_dir, *rel.split("/"))
+        try:
+            st = os.stat(path)
+        except OSError:
+            missing.append(f)
+            continue
+        entry = build_cache.get(rel)
+        if (entry == None or entry['size'] != st.st_size
+                or entry['mtime_ns'] != st.st_mtime_ns):
+            entry = { 'size': st.st_size, 'mtime_ns': st.st_mtime_ns,
+                    'sha256': sha256_of_file(path) }
+            hashed += 1
+        seen[rel] = entry
+        reference[f] = entry['sha256']
+    build_cache.clear()
+    build_cache.update(seen)
+    for f, descr in base.items():
+        if not f.startswith("/static/"):
+            reference[f] = descr
+    return dict(sorted(reference.items())), hashed, missing
+
+# Print the differences between two references; return True if there
+# are none
+def diff_references(old, new):
+    same = True
+    def flat(reference):
+        res = {}
+        for f, descr in reference.items():
+            if type(descr) == dict:
+                for lang, h in descr.items():
+                    res["{} [{}]".format(f, lang)] = h
+            else:
+                res[f] = descr
+        return res
+    old = flat(old)
+    new = flat(new)
+    for f in sorted(set(old) | set(new)):
+        if f not in new:
+            print("- {}".format(f))
+        elif f not in old:
+            print("+ {} {}".format(f, new[f]))
+        elif old[f] != new[f]:
+            print("~ {} {} -> {}".format(f, old[f], new[f]))
+        else:
+            continue
+        same = False
+    return same
 
 parser = argparse.ArgumentParser(description="monitor files served by a Belenios server")
-parser.add_argument("--url", required=True, help="prefix url of the Belenios server")
-parser.add_argument("--reference", required=True, help="reference file")
-parser.add_argument("--output", help="output new reference to this file")
+parser.add_argument("--url", action="append",
+        help="prefix url of the Belenios server (can be given several times)")
+parser.add_argument("--reference", help="reference file")
+parser.add_argument("--output", help="output new reference to this file (with a single --url)")
+parser.add_argument("--max-connections", type=int, default=4, metavar="N",
+        help="maximum number of simultaneous connections to the server")
+parser.add_argument("--jobs", type=int, metavar="N",
+        help="number of files downloaded concurrently (default: --max-connections times the number of urls)")
+parser.add_argument("--cache", metavar="FILE",
+        help="keep the validators and hashes of the files in this file, so that unchanged files are not downloaded again")
+parser.add_argument("--timing", action="store_true",
+        help="print the time taken by each request, and a summary by method and status")
+
+parser.add_argument("--build", metavar="DIR",
+        help="instead of checking a server, build a reference from the static files installed in DIR (share/belenios-server), taking the hashes of vote.html from --reference if given")
+parser.add_argument("--build-cache", metavar="FILE",
+        help="with --build, keep the size, mtime and hash of the files in this file, so that only the files that changed are hashed again")
+parser.add_argument("--diff", nargs=2, metavar=("OLD", "NEW"),
+        help="instead of checking a server, print the differences between two references")
 
 args = parser.parse_args()
 
-url = args.url.strip("/")
+if args.diff:
+    with open(args.diff[0]) as f:
+        old = json.load(f)
+    with open(args.diff[1]) as f:
+        new = json.load(f)
+    if not diff_references(old, new):
+        sys.exit(1)
+    sys.exit(0)
+
+if args.build:
+    if not args.output:
+        print("--build needs --output")
+        sys.exit(1)
+    base = {}
+    if args.reference:
+        with open(args.reference) as f:
+            base = json.load(f)
+    build_cache = {}
+    if args.build_cache:
+        build_cache = load_cache(args.build_cache)
+    new_reference, hashed, missing = build_reference(args.build, base,
+            build_cache)
+    if args.build_cache:
+        save_cache(args.build_cache, build_cache)
+    if missing != []:
+        for f in missing:
+            print("Static file {} is not in {}".format(f, args.build))
+        sys.exit(1)
+    with open(args.output, mode="w") as f:
+        json.dump(new_reference, f)
+    if args.timing:
+        print("{} file(s), {} hashed".format(len(build_cache), hashed))
+    sys.exit(0)
+
+if not args.url or not args.reference:
+    print("--url and --reference are needed to check a server")
+    sys.exit(1)
+
+if args.output and len(args.url) > 1:
+    print("--output needs a single --url")
+    sys.exit(1)
+
+# with --timing, each request is printed when it is done
+pool = http_pool.ConnectionPool(per_host=args.max_connections,
+        log=print if args.timing else None)
+
+if args.cache:
+    cache = load_cache(args.cache)
+
+jobs = args.jobs
+if jobs == None:
+    jobs = args.max_connections * len(args.url)
 
 fail = False
+# some file could not be downloaded
+missing = False
 
 with open(args.reference) as f:
     reference = json.load(f)
 
 new_reference = {}
 
-for f, descr in reference.items():
-    if type(descr) == dict:
-        new_reference[f] = {}
-        for lang, descr in descr.items():
-            h = hash_votefile(url + f, lang)
-            new_reference[f][lang] = h
-            if h != descr:
-                fail = True
-                print("Wrong hash of {} in {}: got {} but expected {}".format(f, lang, h, descr))
-    else:
-        h = hash_file(url + f)
-        new_reference[f] = h
-        if h != descr:
-            fail = True
-            print("Wrong hash of static file {}: got {} but expected {}".format(f, h, descr))
-
-if args.output:
+# all the files of all the servers are fetched concurrently; the results
+# are checked in the order of the reference
+with concurrent.futures.ThreadPoolExecutor(max(jobs, 1)) as ex:
+    results = {}
+    for u in args.url:
+        url = u.strip("/")
+        for f, descr in reference.items():
+            if type(descr) == dict:
+                for lang in descr:
+                    results[(url, f, lang)] = ex.submit(hash_votefile, url + f, lang)
+            else:
+                results[(url, f, None)] = ex.submit(hash_file, url + f)
+
+    for u in args.url:
+        url = u.strip("/")
+        for f, descr in reference.items():
+            if type(descr) == dict:
+                new_reference[f] = {}
+                for lang, descr in descr.items():
+                    h = results[(url, f, lang)].result()
+                    if h == None:
+                        fail = missing = True
+                        continue
+                    new_reference[f][lang] = h
+                    if h != descr:
+                        fail = True
+                        print("Wrong hash of {}{} in {}: got {} but expected {}".format(url, f, lang, h, descr))
+            else:
+                h = results[(url, f, None)].result()
+                if h == None:
+                    fail = missing = True
+                    continue
+                new_reference[f] = h
+                if h != descr:
+                    fail = True
+                    print("Wrong hash of static file {}{}: got {} but expected {}".format(url, f, h, descr))
+
+pool.close()
+if args.timing:
+    print(pool.report())
+
+if args.cache:
+    save_cache(args.cache, cache)
+
+if args.output and not missing:
     with open(args.output, mode="w") as f:
         json.dump(new_reference, f)
 
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+# Content-addressed store of the snapshots of an election, used by
+# monitor_elections.py (with --archive chunks) instead of git.
+#
+# Each file of a snapshot is cut into chunks at content-defined
+# positions, and each chunk is stored once, named by its hash. Since the
+# cut positions only depend on the nearby content, the unchanged parts
+# of a file (typically all but the end of ballots.jsons) give the same
+# chunks as in the previous snapshot, and are not stored again.
+#
+# Layout, in the directory of the election:
+#   chunks/ab/abcd...     chunk with sha256 abcd..., zlib-compressed
+#   snapshots/000042.json description of snapshot 42: date, commit
+#                         message, failure, and the list of chunks of
+#                         each file
+#
+# Usage (to inspect the archive of an election):
+#   ./chunk_store.py list /tmp/wdir/<uuid>
+#   ./chunk_store.py restore /tmp/wdir/<uuid> 42 /tmp/snapshot42
+#   ./chunk_store.py verify-diff /tmp/wdir/<uuid> 41 42
+
+import argparse
+import os
+import sys
+import re
+import json
+import zlib
+import hashlib
+import datetime
+import tempfile
+import subprocess
+
+# Chunks are cut just after a separator (a newline, or the end of an
+# HTML tag since web pages may be on a single line), when the CRC of
+# the text since the previous separator has its low bits at zero and
+# the chunk is long enough. Chunks are also cut when they get too long.
+SEPARATORS = re.compile(rb'[\n>]')
+MIN_CHUNK = 8 * 1024
+MAX_CHUNK = 256 * 1024
+CUT_MASK = 0xff
+
+def cut_points(content):
+    start = 0
+    prev = 0
+    for mat in SEPARATORS.finditer(content):
+        end = mat.end()
+        while end - start > MAX_CHUNK:
+            start = start + MAX_CHUNK
+            yield start
+        if (end - start >= MIN_CHUNK and
+                zlib.crc32(content[prev:end]) & CUT_MASK == 0):
+            yield end
+            start = end
+        prev = end
+    while len(content) - start > MAX_CHUNK:
+        start = start + MAX_CHUNK
+        yield start
+    if start < len(content):
+        yield len(content)
+
+def write_atomic(path, content):
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(fd, "wb") as file:
+        file.write(content)
+    os.replace(tmp, path)
+
+class ChunkStore:
+    def __init__(self, path):
+        self.path = path
+        self.chunks = os.path.join(path, "chunks")
+        self.snaps = os.path.join(path, "snapshots")
+        os.makedirs(self.chunks, exist_ok=True)
+        os.makedirs(self.snaps, exist_ok=True)
+
+    def chunk_path(self, h):
+        return os.path.join(self.chunks, h[0:2], h)
+
+    # Store the chunks of content; return the list of their hashes and
+    # the number of bytes that were not already stored.
+    def put_file(self, content):
+        ids = []
+        new = 0
+        start = 0
+        for end in cut_points(content):
+            chunk = content[start:end]
+            h = hashlib.sha256(chunk).hexdigest()
+            p = self.chunk_path(h)
+            if not os.path.exists(p):
+                os.makedirs(os.path.dirname(p), exist_ok=True)
+                write_atomic(p, zlib.compress(chunk))
+                new += len(chunk)
+            ids.append(h)
+            start = end
+        return ids, new
+
+    def get_file(self, ids):
+        parts = []
+        for h in ids:
+            with open(self.chunk_path(h), "rb") as file:
+                chunk = zlib.decompress(file.read())
+            if hashlib.sha256(chunk).hexdigest() != h:
+                raise ValueError("corrupted chunk {}".format(h))
+            parts.append(chunk)
+        return b"".join(parts)
+
+    def snapshots(self):
+        return sorted(int(x[:-5]) for x in os.listdir(self.snaps)
+                if x.endswith(".json"))
+
+    def snapshot_path(self, n):
+        return os.path.join(self.snaps, "{:06d}.json".format(n))
+
+    def load_snapshot(self, n):
+        with open(self.snapshot_path(n), "r") as file:
+            return json.load(file)
+
+    # Record a snapshot made of files (a dict from file names to their
+    # content); return its number and the number of new bytes stored.
+    def add_snapshot(self, files, message, fail):
+        snap = { 'date': str(datetime.datetime.now()),
+                'message': message, 'fail': fail, 'files': {} }
+        new = 0
+        for f, content in files.items():
+            ids, n = self.put_file(content)
+            snap['files'][f] = { 'size': len(content), 'chunks': ids }
+            new += n
+        snaps = self.snapshots()
+        n = snaps[-1] + 1 if snaps != [] else 1
+        write_atomic(self.snapshot_path(n), json.dumps(snap).encode())
+        return n, new
+
+    # Write the files of snapshot n in directory d
+    def restore(self, n, d):
+        snap = self.load_snapshot(n)
+        os.makedirs(d, exist_ok=True)
+        for f, descr in snap['files'].items():
+            content = self.get_file(descr['chunks'])
+            assert len(content) == descr['size']
+            with open(os.path.join(d, f), "wb") as file:
+                file.write(content)
+
+def main():
+    parser = argparse.ArgumentParser(description="inspect the snapshots of an election monitored with --archive chunks")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("list", help="list the snapshots")
+    p.add_argument("eldir", help="directory of the election")
+    p = sub.add_parser("restore", help="write the files of a snapshot in a directory")
+    p.add_argument("eldir", help="directory of the election")
+    p.add_argument("snapshot", type=int)
+    p.add_argument("dir")
+    p = sub.add_parser("verify-diff", help="run belenios-tool verify-diff between two snapshots")
+    p.add_argument("eldir", help="directory of the election")
+    p.add_argument("snapshot1", type=int)
+    p.add_argument("snapshot2", type=int)
+    args = parser.parse_args()
+
+    store = ChunkStore(args.eldir)
+    if args.command == "list":
+        for n in store.snapshots():
+            snap = store.load_snapshot(n)
+            size = sum(x['size'] for x in snap['files'].values())
+            print("{} {} {} {} bytes {}".format(n, snap['date'],
+                "FAIL" if snap['fail'] else "ok", size,
+                snap['message'].splitlines()[0] if snap['message'] else ""))
+    elif args.command == "restore":
+        store.restore(args.snapshot, args.dir)
+    else:
+        with tempfile.TemporaryDirectory() as d1, tempfile.TemporaryDirectory() as d2:
+            store.restore(args.snapshot1, d1)
+            store.restore(args.snapshot2, d2)
+            verdiff = subprocess.run(["belenios-tool", "verify-diff",
+                "--dir1={}".format(d1), "--dir2={}".format(d2)])
+            sys.exit(verdiff.returncode)
+
+if __name__ == "__main__":
+    main()
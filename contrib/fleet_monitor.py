@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+# Monitor all the live elections of a Belenios server: this does the job
+# of list_live_elections.py and monitor_elections.py together, in a
+# single process.
+#
+# On the server host, the live elections are found directly in the
+# spool, and the metadata of each election is kept in memory, so that in
+# daemon mode only the elections whose files changed are examined again
+# (with --spool-cache, this is also kept on disk between runs):
+#   ./fleet_monitor.py --spool /path/to/spool --spool-cache /tmp/spool.sqlite --daemon --jobs 8 --url https://belenios.loria.fr/beta/ --wdir /tmp/wdir
+#
+# Elsewhere, the elections are read from an index, i.e. a file with one
+# uuid per line (for instance the output of list_live_elections.py on the
+# server, copied regularly), read again whenever it changes:
+#   ./fleet_monitor.py --index live.txt --daemon --url https://belenios.loria.fr/beta/ --wdir /tmp/wdir
+#
+# All the options of monitor_elections.py are accepted. After each cycle,
+# a summary of the whole fleet is logged: how many elections are live,
+# why the others are not, how many ballots they have, and which ones
+# are failing.
+
+# External dependencies:
+# - monitor_elections.py  (from the belenios source dist, in contrib/,
+#   with its own dependencies)
+# - list_live_elections.py  (idem)
+
+import os
+import sys
+import time
+import datetime
+import monitor_elections
+import list_live_elections
+from monitor_elections import logme, Elogme
+
+# State of the fleet, kept between cycles
+class Fleet:
+    def __init__(self, spool, index, spool_cache=None, scan_jobs=8):
+        self.index = index
+        self.spool = None
+        if spool != None:
+            db = None
+            if spool_cache != None:
+                db = list_live_elections.SpoolIndex(spool_cache)
+            self.spool = list_live_elections.SpoolCache(spool, db, scan_jobs)
+        # (mtime, size) of the index, and the uuids it lists
+        self.index_stamp = None
+        self.index_uuids = []
+        # uuid -> reason why it is not live, after the last discovery
+        self.excluded = {}
+        self.live = []
+        # uuid -> (time, failed, number of ballots) of its last poll
+        self.results = {}
+
+    def read_index(self):
+        st = os.stat(self.index)
+        stamp = (st.st_mtime_ns, st.st_size)
+        if stamp != self.index_stamp:
+            with open(self.index, "r") as file:
+                uuids = [ x.strip() for x in file ]
+            self.index_uuids = [ x for x in uuids
+                    if x != '' and not x.startswith('#') ]
+            self.index_stamp = stamp
+            logme("Fleet: read {} election(s) from {}".format(
+                len(self.index_uuids), self.index))
+        return list(self.index_uuids)
+
+    # List the live elections (called before each cycle)
+    def discover(self, args=None):
+        if self.spool == None:
+            self.live = self.read_index()
+            self.excluded = {}
+        else:
+            elections = self.spool.scan()
+            self.live = [ uuid for uuid, reason in elections if reason == None ]
+            self.excluded = { uuid: reason for uuid, reason in elections
+                    if reason != None }
+            logme("Fleet: {} election(s) in the spool, {} live, metadata of {} read again".format(
+                len(elections), len(self.live), self.spool.parsed))
+        for uuid in list(self.results):
+            if uuid not in self.live:
+                del self.results[uuid]
+        return list(self.live)
+
+    def name(self, uuid):
+        if self.spool != None and uuid in self.spool.elections:
+            name = self.spool.elections[uuid].name
+            if name != None:
+                return "{} ({})".format(uuid, name)
+        return uuid
+
+    def done(self, uuid, status, data):
+        ballots = None
+        if 'ballots.jsons' in data:
+            ballots = monitor_elections.ballots_count(data)
+        self.results[uuid] = (time.time(), status.fail, ballots)
+
+    # Fleet-wide summary, after each cycle
+    def report(self, polled, failed):
+        logme("Fleet: polled {} election(s), {} failed".format(len(polled),
+            len(failed)))
+        if self.excluded != {}:
+            reasons = {}
+            for reason in self.excluded.values():
+                reasons[reason] = reasons.get(reason, 0) + 1
+            logme("Fleet: {} election(s) not monitored: {}".format(
+                len(self.excluded), ", ".join("{} {}".format(n, r)
+                    for r, n in sorted(reasons.items()))))
+        failing = sorted(uuid for uuid, r in self.results.items() if r[1])
+        ballots = sum(r[2] for r in self.results.values() if r[2] != None)
+        logme("Fleet: {} live election(s), {} checked at least once, {} ballot(s) in total, {} failing".format(
+            len(self.live), len(self.results), ballots, len(failing)))
+        for uuid in failing:
+            Elogme("Fleet: failing since {}: {}".format(
+                datetime.datetime.fromtimestamp(self.results[uuid][0]).strftime("%Y-%m-%d %H:%M:%S"),
+                self.name(uuid)))
+
+def main():
+    parser = monitor_elections.make_parser("monitor all the live elections of a Belenios server")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--spool", help="spool directory of the server, where the live elections are looked for")
+    group.add_argument("--index", help="file containing the uuid's of the live elections, when the spool is not available")
+    parser.add_argument("--spool-cache", metavar="FILE",
+            help="with --spool, keep the metadata of the elections in this index (see list_live_elections.py --cache), so that a restart does not examine the whole spool again")
+    parser.add_argument("--scan-jobs", type=int, default=8, metavar="N",
+            help="with --spool, number of elections examined concurrently")
+    args = parser.parse_args()
+    if args.spool != None and not os.path.isdir(args.spool):
+        print("The spool {} should be a directory".format(args.spool))
+        sys.exit(1)
+    if args.scan_jobs < 1:
+        print("The number of jobs should be at least 1")
+        sys.exit(1)
+    monitor_elections.setup(args)
+    fleet = Fleet(args.spool, args.index, args.spool_cache,
+            args.scan_jobs)
+
+    logme("[{}] Starting monitoring the fleet.".format(datetime.datetime.now()))
+
+    if args.daemon:
+        monitor_elections.run_daemon(args, fleet.discover, fleet.done,
+                fleet.report)
+
+    uuids = fleet.discover()
+    failed = monitor_elections.monitor_elections(args, uuids, fleet.done)
+    fleet.report(uuids, failed)
+
+    pool = monitor_elections.pool
+    pool.close()
+    logme("HTTP: " + pool.report().splitlines()[-1])
+    if monitor_elections.metrics_sink != None:
+        monitor_elections.metrics_sink.write_prom()
+
+    ok = True
+    if args.checkhash == True:
+        ok = monitor_elections.check_static_files(args)
+
+    if monitor_elections.log_file != None:
+        monitor_elections.log_file.close()
+
+    if failed != [] or not ok:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+# HTTP client shared by the monitoring scripts (monitor_elections.py,
+# check_hash.py). Compared to urllib.request.urlopen, it:
+#  - keeps connections alive and reuses them (one TCP/TLS handshake per
+#    connection instead of one per request)
+#  - limits the number of simultaneous connections to each host
+#  - asks for gzip/deflate compressed responses, and decompresses them
+#  - records the number of requests, their size and the time they took,
+#    for each method and status
+# Errors are reported with the same exceptions as urllib
+# (urllib.error.HTTPError for HTTP error codes, including 304,
+# urllib.error.URLError otherwise), so that it can be used in place of
+# urlopen.
+
+import http.client
+import urllib.parse
+import urllib.error
+import threading
+import time
+import zlib
+import ssl
+
+MAX_REDIRECTS = 5
+CHUNK_SIZE = 65536
+
+# A response whose body has already been read (and decoded).
+class Response:
+    def __init__(self, url, status, headers, body, elapsed):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.elapsed = elapsed
+    def read(self):
+        return self.body
+
+# Incremental decoder of a body with the Content-Encoding of headers
+class Decoder:
+    def __init__(self, headers):
+        enc = (headers.get('Content-Encoding') or 'identity').strip().lower()
+        self.enc = enc
+        self.obj = None
+        if enc == 'gzip':
+            self.obj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    def decode(self, chunk):
+        if self.enc == 'deflate' and self.obj == None and chunk != b'':
+            # some servers send raw deflate data without zlib header
+            if chunk[0] & 0x0f == 8:
+                self.obj = zlib.decompressobj()
+            else:
+                self.obj = zlib.decompressobj(-zlib.MAX_WBITS)
+        if self.obj == None:
+            return chunk
+        return self.obj.decompress(chunk)
+    def flush(self):
+        if self.obj == None:
+            return b''
+        return self.obj.flush()
+
+def decode_body(headers, body):
+    d = Decoder(headers)
+    return d.decode(body) + d.flush()
+
+class ConnectionPool:
+    # per_host: maximum number of simultaneous connections to a host
+    # log: if not None, function called with a line describing each request
+    # observe: if not None, function called with (method, url, status,
+    #   bytes, seconds) after each request, in the thread doing it
+    def __init__(self, per_host=4, timeout=60, log=None, observe=None):
+        self.per_host = per_host
+        self.timeout = timeout
+        self.log = log
+        self.observe = observe
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.slots = {}
+        self.context = ssl.create_default_context()
+        # (method, status) -> [requests, bytes, seconds, max seconds],
+        # since the last reset
+        self.timings = {}
+
+    def _slot(self, key):
+        with self.lock:
+            if key not in self.slots:
+                self.slots[key] = threading.BoundedSemaphore(self.per_host)
+            return self.slots[key]
+
+    def _get_conn(self, key):
+        with self.lock:
+            conns = self.idle.get(key)
+            if conns:
+                return conns.pop(), True
+        scheme, host, port = key
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(host, port,
+                    timeout=self.timeout, context=self.context)
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=self.timeout)
+        return conn, False
+
+    def _put_conn(self, key, conn):
+        with self.lock:
+            self.idle.setdefault(key, []).append(conn)
+
+    def close(self):
+        with self.lock:
+            for conns in self.idle.values():
+                for conn in conns:
+                    conn.close()
+            self.idle = {}
+
+    # Send one request on a pooled connection, retrying once on a fresh
+    # connection if a reused one was closed by the server in between.
+    def _send(self, key, method, path, headers):
+        while True:
+            conn, reused = self._get_conn(key)
+            try:
+                conn.request(method, path, headers=headers)
+                return conn, conn.getresponse()
+            except (http.client.HTTPException, OSError):
+                conn.close()
+                if reused:
+                    continue
+                raise
+
+    # Read the body of resp, either in memory, or (if sink is not None)
+    # by passing decoded chunks to sink; return the body in memory (or
+    # b'') and its size on the wire.
+    def _read(self, key, conn, resp, sink):
+        try:
+            if sink == None:
+                body = resp.read()
+                n = len(body)
+            else:
+                body = b''
+                n = 0
+                d = Decoder(resp.headers)
+                while True:
+                    chunk = resp.read(CHUNK_SIZE)
+                    if chunk == b'':
+                        break
+                    n += len(chunk)
+                    sink(d.decode(chunk))
+                sink(d.flush())
+        except:
+            conn.close()
+            raise
+        if resp.will_close:
+            conn.close()
+        else:
+            self._put_conn(key, conn)
+        return body, n
+
+    # If sink is not None, the body of a successful response is passed
+    # to it by chunks (decoded) instead of being kept in the response.
+    def request(self, url, headers={}, method='GET', sink=None):
+        headers = dict(headers)
+        if 'Range' in headers:
+            # ranges of compressed representations are useless to us
+            headers.setdefault('Accept-Encoding', 'identity')
+        else:
+            headers.setdefault('Accept-Encoding', 'gzip, deflate')
+        for i in range(MAX_REDIRECTS + 1):
+            u = urllib.parse.urlsplit(url)
+            port = u.port or (443 if u.scheme == 'https' else 80)
+            key = (u.scheme, u.hostname, port)
+            path = u.path or '/'
+            if u.query:
+                path = path + '?' + u.query
+            start = time.monotonic()
+            slot = self._slot(key)
+            with slot:
+                try:
+                    conn, resp = self._send(key, method, path, headers)
+                    ok = 200 <= resp.status < 300
+                    body, n = self._read(key, conn, resp,
+                            sink if ok else None)
+                except (http.client.HTTPException, OSError, zlib.error) as e:
+                    raise urllib.error.URLError(e)
+            elapsed = time.monotonic() - start
+            with self.lock:
+                t = self.timings.setdefault((method, resp.status),
+                        [0, 0, 0.0, 0.0])
+                t[0] += 1
+                t[1] += n
+                t[2] += elapsed
+                t[3] = max(t[3], elapsed)
+            if self.log != None:
+                self.log("{} {} {} {} bytes in {:.3f}s".format(method, url,
+                    resp.status, n, elapsed))
+            if self.observe != None:
+                self.observe(method, url, resp.status, n, elapsed)
+            if resp.status in (301, 302, 303, 307, 308) and resp.getheader('Location'):
+                url = urllib.parse.urljoin(url, resp.getheader('Location'))
+                continue
+            if resp.status >= 300:
+                raise urllib.error.HTTPError(url, resp.status, resp.reason,
+                        resp.headers, None)
+            if sink == None:
+                try:
+                    body = decode_body(resp.headers, body)
+                except zlib.error as e:
+                    raise urllib.error.URLError(e)
+            return Response(url, resp.status, resp.headers, body, elapsed)
+        raise urllib.error.URLError("too many redirects for {}".format(url))
+
+    # Human-readable summary of the requests done so far (since the
+    # previous reset); the last line is the total. With reset, the next
+    # report starts from zero (e.g. after each cycle of a daemon).
+    def report(self, reset=False):
+        with self.lock:
+            timings = sorted(self.timings.items())
+            if reset:
+                self.timings = {}
+        lines = []
+        count = 0
+        nbytes = 0
+        total = 0
+        for (method, status), (k, n, elapsed, longest) in timings:
+            lines.append("{} {}: {} request(s), {} bytes, {:.3f}s (longest {:.3f}s)".format(
+                method, status, k, n, elapsed, longest))
+            count += k
+            nbytes += n
+            total += elapsed
+        lines.append("{} request(s), {} bytes, {:.3f}s".format(count,
+            nbytes, total))
+        return "\n".join(lines)
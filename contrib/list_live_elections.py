@@ -6,18 +6,51 @@ import sys
 import re
 import json
 import datetime
+import time
+import sqlite3
+import concurrent.futures
+import ctypes
+import ctypes.util
+import errno
+import select
+import struct
 
 MIN_VOTERS=5
 MAX_TALLIED_AGE=7       # expressed in days
 MAX_FINALIZED_AGE=30    # expressed in days
 
 # verb is a global variable, controlled by --verbose
+verb = False
 def verb_print(str):
     if (verb):
         print(str, file=sys.stderr)
 
 def all_uuid(path):
-    return [ f for f in os.listdir(path) if os.path.isdir(os.path.join(path, f)) ]
+    with os.scandir(path) as it:
+        return [ e.name for e in it if e.is_dir() ]
+
+# Directories of the elections of the spool, as os.DirEntry: their type
+# usually comes with the directory listing, without a stat (on Linux,
+# DirEntry.stat() still makes one call, cached afterwards)
+def election_entries(path):
+    with os.scandir(path) as it:
+        return [ e for e in it if e.is_dir() ]
+
+# Number of lines of a file, counted by blocks rather than line by line
+def count_lines(path):
+    n = 0
+    last = b'\n'
+    with open(path, "rb") as file:
+        while True:
+            block = file.read(1 << 20)
+            if block == b'':
+                break
+            n += block.count(b'\n')
+            last = block[-1:]
+    # like iterating over the lines, count a last line without newline
+    if last != b'\n':
+        n += 1
+    return n
 
 def is_draft_or_deleted(elec_path):
     if os.path.exists(os.path.join(elec_path, "deleted.json")):
@@ -30,6 +63,10 @@ def is_secure(elec_path):
     assert os.path.exists(meta)
     with open(meta,"r") as file:
         data = json.load(file)
+    return is_secure_data(data)
+
+# data: content of metadata.json
+def is_secure_data(data):
     if 'cred_authority' in data and data['cred_authority'] != 'server':
         return True
     if 'trustees' in data:
@@ -37,27 +74,32 @@ def is_secure(elec_path):
             return True
     return False
 
-def is_test(elec_path):
+def read_election(elec_path):
     elec = os.path.join(elec_path, "election.json")
-    assert os.path.exists(elec)
     with open(elec,"r") as file:
-        data = json.load(file)
+        return json.load(file)
+
+# data: content of election.json
+def is_test_data(elec_path, data):
     if re.search("test", data['name'], re.IGNORECASE) != None:
         return True
     voters = os.path.join(elec_path, "voters.txt")
-    num_voters = sum(1 for line in open(voters, "r"))
-    if num_voters < MIN_VOTERS:
+    if count_lines(voters) < MIN_VOTERS:
         return True
     return False
 
-def is_old(elec_path):
+def is_test(elec_path):
+    return is_test_data(elec_path, read_election(elec_path))
+
+def read_dates(elec_path):
     dates = os.path.join(elec_path, "dates.json")
     assert os.path.exists(dates)
     with open(dates,"r") as file:
-        data = json.load(file)
+        return json.load(file)
+
+def is_old_dates(data, now):
     if 'archive' in data:
         return True
-    now = datetime.datetime.now()
     if 'tally' in data:
         tallied = data['tally']
         tt = datetime.datetime.strptime(tallied, "%Y-%m-%d %H:%M:%S.%f")
@@ -72,26 +114,419 @@ def is_old(elec_path):
             return True
     return False
 
-parser = argparse.ArgumentParser(description="list elections that are alive and deserve to be monitored")
-parser.add_argument("spool_directory",
-        help="Spool directory where the elections are stored")
-parser.add_argument("--verbose", help="explain why elections are discarded on stderr", action="store_true")
-args = parser.parse_args()
-verb = args.verbose
+def is_old(elec_path):
+    return is_old_dates(read_dates(elec_path), datetime.datetime.now())
+
+# The server writes the files of an election by renaming a new version
+# over the old one (or creates and deletes them), so the modification
+# time of the directory of an election changes whenever one of its files
+# does. A directory modified less than RACY_SECONDS ago may be modified
+# again without its mtime changing visibly, so it is examined again on
+# the next scan.
+RACY_SECONDS = 2
+
+# entry: os.DirEntry of the directory of the election
+def dir_stamp(entry, now):
+    mtime = entry.stat().st_mtime_ns
+    if mtime > (now - RACY_SECONDS) * 1e9:
+        return None
+    return mtime
 
-uuids = all_uuid(args.spool_directory)
-for uuid in uuids:
-    elec_path = os.path.join(args.spool_directory, uuid)
+# What we know about an election of the spool, read from its files. The
+# age of an election depends on the current time, so we keep its dates
+# rather than the result of is_old.
+class ElectionInfo:
+    def __init__(self, stamp, draft_or_deleted=False, test=False,
+            secure=False, dates=None, name=None, error=None):
+        self.stamp = stamp
+        self.draft_or_deleted = draft_or_deleted
+        self.test = test
+        self.secure = secure
+        self.dates = dates
+        self.name = name
+        self.error = error
+
+    # None if the election is live, otherwise why it is not
+    def reason(self, now):
+        if self.draft_or_deleted:
+            return "deleted or not yet finalized"
+        if self.error != None:
+            return "unreadable ({})".format(self.error)
+        if self.test:
+            return "probably a test election"
+        if not self.secure:
+            return "in degraded mode"
+        try:
+            if is_old_dates(self.dates, now):
+                return "old"
+        except (ValueError, KeyError) as e:
+            return "unreadable (dates.json: {})".format(e)
+        return None
+
+def examine(elec_path, stamp):
+    info = ElectionInfo(stamp)
     if is_draft_or_deleted(elec_path):
-        verb_print("Election {} is deleted or not yet finalized".format(uuid))
-        continue
-    if is_test(elec_path):
-        verb_print("Election {} is probably a test election".format(uuid))
-        continue
-    if not is_secure(elec_path):
-        verb_print("Election {} is in degraded mode".format(uuid))
-        continue
-    if is_old(elec_path):
-        verb_print("Election {} is old".format(uuid))
-        continue
-    print(uuid)    
+        info.draft_or_deleted = True
+        return info
+    try:
+        data = read_election(elec_path)
+        info.name = data.get('name')
+        info.test = is_test_data(elec_path, data)
+        info.secure = is_secure(elec_path)
+        info.dates = read_dates(elec_path)
+    except (OSError, ValueError, KeyError, AssertionError) as e:
+        info.error = "{}: {}".format(type(e).__name__, e)
+    return info
+
+# Persistent index of a spool (--cache), so that only the elections
+# whose directory changed since the previous run are examined: for each
+# election, the mtime of its directory when it was examined, and what
+# was found. The flags depend on MIN_VOTERS, so the index is emptied
+# when it changes.
+class SpoolIndex:
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS elections (uuid TEXT PRIMARY KEY, mtime INTEGER, draft_or_deleted INTEGER, test INTEGER, secure INTEGER, dates TEXT, name TEXT, error TEXT)")
+        rules = "min_voters={}".format(MIN_VOTERS)
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'rules'").fetchone()
+        if row == None or row[0] != rules:
+            self.db.execute("DELETE FROM elections")
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('rules', ?)",
+                    (rules,))
+        self.db.commit()
+
+    # Dict from uuids to their ElectionInfo
+    def load(self):
+        res = {}
+        for row in self.db.execute("SELECT * FROM elections"):
+            uuid, mtime, dd, test, secure, dates, name, error = row
+            res[uuid] = ElectionInfo(mtime, bool(dd), bool(test), bool(secure),
+                    json.loads(dates) if dates != None else None, name, error)
+        return res
+
+    # changed: dict from uuids to their new ElectionInfo; removed: uuids
+    # that are no longer in the spool
+    def update(self, changed, removed):
+        self.db.executemany("INSERT OR REPLACE INTO elections VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                ( (uuid, i.stamp, int(i.draft_or_deleted), int(i.test),
+                    int(i.secure),
+                    json.dumps(i.dates) if i.dates != None else None,
+                    i.name, i.error) for uuid, i in changed.items() ))
+        self.db.executemany("DELETE FROM elections WHERE uuid = ?",
+                ( (uuid,) for uuid in removed ))
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+# Metadata of the elections of a spool directory, kept in memory between
+# scans by long-running users (see fleet_monitor.py), and on disk if an
+# index is given: an election is only examined again when its directory
+# changed. The elections are examined by a pool of jobs threads, so that
+# their reads overlap.
+class SpoolCache:
+    def __init__(self, spool, index=None, jobs=8):
+        self.spool = spool
+        self.index = index
+        self.jobs = jobs
+        # uuid -> ElectionInfo
+        self.elections = {}
+        if index != None:
+            self.elections = index.load()
+        # number of elections examined during the last scan
+        self.parsed = 0
+
+    # Return the list of (uuid, reason) of all the elections of the spool,
+    # reason being None for live elections
+    def scan(self):
+        now = datetime.datetime.now()
+        t = time.time()
+        def check(entry):
+            stamp = dir_stamp(entry, t)
+            info = self.elections.get(entry.name)
+            if stamp == None or info == None or info.stamp != stamp:
+                return examine(entry.path, stamp), True
+            return info, False
+        entries = election_entries(self.spool)
+        with concurrent.futures.ThreadPoolExecutor(self.jobs) as ex:
+            results = list(ex.map(check, entries))
+        seen = {}
+        changed = {}
+        for entry, (info, new) in zip(entries, results):
+            seen[entry.name] = info
+            if new:
+                changed[entry.name] = info
+        removed = [ uuid for uuid in self.elections if uuid not in seen ]
+        if self.index != None:
+            self.index.update(changed, removed)
+        self.elections = seen
+        self.parsed = len(changed)
+        return [ (uuid, info.reason(now))
+                for uuid, info in sorted(seen.items()) ]
+
+    def live(self):
+        return [ uuid for uuid, reason in self.scan() if reason == None ]
+
+# The server appends a line to registry.jsons, in the root of the spool,
+# at each step of the life of an election: Created, Validated (with the
+# name, number of voters and metadata needed here), Opened, Closed,
+# Tallied, Archived, Deleted. Return a dict from uuids to their
+# ElectionInfo, rebuilt from this file. The elections of the spool that
+# were validated before the server kept a registry (no Created,
+# Validated or Deleted event) are examined in the spool instead.
+REGISTRY_FILE = "registry.jsons"
+
+def read_registry(spool):
+    elections = {}
+    # uuids whose state is known from the registry
+    known = set()
+    with open(os.path.join(spool, REGISTRY_FILE), "r") as file:
+        for line in file:
+            if line.strip() == '':
+                continue
+            e = json.loads(line)
+            uuid, event = e['uuid'], e['event']
+            info = elections.get(uuid)
+            if info == None:
+                info = ElectionInfo(None, dates={})
+                elections[uuid] = info
+            if event in ('Created', 'Validated', 'Deleted'):
+                known.add(uuid)
+            if event == 'Created':
+                info.draft_or_deleted = True
+                info.name = e.get('name')
+            elif event == 'Validated':
+                info.draft_or_deleted = False
+                info.name = e.get('name')
+                info.test = (re.search("test", info.name or '', re.IGNORECASE) != None
+                        or e.get('nb_voters', 0) < MIN_VOTERS)
+                info.secure = is_secure_data(e)
+                info.dates['finalization'] = e['date']
+            elif event == 'Tallied':
+                info.dates['tally'] = e['date']
+            elif event == 'Archived':
+                info.dates['archive'] = e['date']
+            elif event == 'Deleted':
+                info.draft_or_deleted = True
+    for uuid in list(elections):
+        if uuid not in known:
+            del elections[uuid]
+    for uuid in all_uuid(spool):
+        if uuid not in known:
+            elections[uuid] = examine(os.path.join(spool, uuid), None)
+    return elections
+
+# Watch mode (--watch, Linux only): the spool and the directory of each
+# election are watched with inotify, and an election is examined again
+# only when one of the files deciding whether it is live changes. Each
+# time an election becomes live or stops being live, a JSON line is
+# printed, e.g.:
+#   {"time": "2021-03-01T10:00:00", "uuid": "...", "live": false, "reason": "old"}
+# At startup, a line is printed for each election of the spool. Since
+# elections also get old with time, whether they are live is evaluated
+# again every AGE_CHECK_SECONDS, without reading anything.
+
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+
+ROOT_MASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_ONLYDIR
+ELECTION_MASK = (IN_CLOSE_WRITE | IN_CREATE | IN_DELETE | IN_MOVED_FROM
+        | IN_MOVED_TO | IN_ONLYDIR)
+WATCHED_FILES = [ "deleted.json", "draft.json", "dates.json",
+        "election.json", "metadata.json", "voters.txt" ]
+# the changes of an election are processed once none of its watched
+# files changed for this delay, since the server writes several files in
+# a row, but at most DEBOUNCE_MAX_SECONDS after the first one
+DEBOUNCE_SECONDS = 0.5
+DEBOUNCE_MAX_SECONDS = 5
+AGE_CHECK_SECONDS = 60
+
+# Minimal binding of the inotify calls of the C library
+class Inotify:
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, "inotify_init1: {}".format(os.strerror(e)))
+
+    def add_watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, "{}: {}".format(path, os.strerror(e)))
+        return wd
+
+    # Wait at most timeout seconds (forever if None) for events; return
+    # the list of (watch descriptor, mask, name)
+    def read(self, timeout):
+        r, _, _ = select.select([self.fd], [], [], timeout)
+        if r == []:
+            return []
+        buf = os.read(self.fd, 65536)
+        events = []
+        i = 0
+        while i < len(buf):
+            wd, mask, cookie, n = struct.unpack_from("iIII", buf, i)
+            name = buf[i+16:i+16+n].rstrip(b'\0')
+            events.append((wd, mask, os.fsdecode(name)))
+            i += 16 + n
+        return events
+
+def watch(spool, jobs=8, out=sys.stdout):
+    ino = Inotify()
+    root = ino.add_watch(spool, ROOT_MASK)
+    # watch descriptor -> uuid, and the set of these uuids
+    wds = {}
+    watched = set()
+    # uuid -> ElectionInfo
+    elections = {}
+    # uuid -> None if the election is live, the reason otherwise, as
+    # last printed
+    printed = {}
+
+    def add_watch(uuid):
+        try:
+            wds[ino.add_watch(os.path.join(spool, uuid), ELECTION_MASK)] = uuid
+            watched.add(uuid)
+        except OSError as e:
+            # the directory is already gone, or is not a directory
+            if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                raise
+
+    # Examine the given elections again (their watches are already set,
+    # so that no change can be missed) and print their transitions
+    def update(uuids):
+        def check(uuid):
+            path = os.path.join(spool, uuid)
+            if not os.path.isdir(path):
+                return None
+            return examine(path, None)
+        with concurrent.futures.ThreadPoolExecutor(jobs) as ex:
+            infos = list(ex.map(check, uuids))
+        for uuid, info in zip(uuids, infos):
+            if info == None:
+                elections.pop(uuid, None)
+            else:
+                elections[uuid] = info
+        report(uuids)
+
+    def report(uuids):
+        now = datetime.datetime.now()
+        for uuid in sorted(uuids):
+            if uuid in elections:
+                reason = elections[uuid].reason(now)
+            else:
+                reason = "removed from the spool"
+            if uuid not in printed or (printed[uuid] == None) != (reason == None):
+                print(json.dumps({ 'time': now.isoformat(timespec='seconds'),
+                    'uuid': uuid, 'live': reason == None,
+                    'reason': reason }), file=out, flush=True)
+            if uuid in elections:
+                printed[uuid] = reason
+            else:
+                printed.pop(uuid, None)
+
+    uuids = all_uuid(spool)
+    for uuid in uuids:
+        add_watch(uuid)
+    update(uuids)
+
+    # uuid -> [time of the first change, time when it is processed]
+    pending = {}
+    def changed(uuid):
+        now = time.monotonic()
+        first = pending[uuid][0] if uuid in pending else now
+        pending[uuid] = [first, min(now + DEBOUNCE_SECONDS,
+            first + DEBOUNCE_MAX_SECONDS)]
+
+    next_age_check = time.monotonic() + AGE_CHECK_SECONDS
+    while True:
+        deadline = min([ d for _, d in pending.values() ] + [next_age_check])
+        events = ino.read(max(0, deadline - time.monotonic()))
+        for wd, mask, name in events:
+            if mask & IN_Q_OVERFLOW:
+                # some events were lost: examine everything again
+                for uuid in all_uuid(spool):
+                    if uuid not in watched:
+                        add_watch(uuid)
+                    changed(uuid)
+                for uuid in elections:
+                    changed(uuid)
+            elif wd == root:
+                if mask & IN_ISDIR:
+                    if mask & (IN_CREATE | IN_MOVED_TO):
+                        add_watch(name)
+                    changed(name)
+            elif wd in wds:
+                if mask & IN_IGNORED:
+                    # the directory was removed
+                    uuid = wds.pop(wd)
+                    watched.discard(uuid)
+                    changed(uuid)
+                elif name in WATCHED_FILES:
+                    changed(wds[wd])
+        now = time.monotonic()
+        ready = sorted(u for u, (_, d) in pending.items() if d <= now)
+        if ready != []:
+            for uuid in ready:
+                del pending[uuid]
+            update(ready)
+        if time.monotonic() >= next_age_check:
+            report(list(elections))
+            next_age_check = time.monotonic() + AGE_CHECK_SECONDS
+
+def main():
+    global verb
+    parser = argparse.ArgumentParser(description="list elections that are alive and deserve to be monitored")
+    parser.add_argument("spool_directory",
+            help="Spool directory where the elections are stored")
+    parser.add_argument("--verbose", help="explain why elections are discarded on stderr", action="store_true")
+    parser.add_argument("--cache", metavar="FILE",
+            help="index of the spool (an SQLite database, created if needed), so that only the elections that changed since the previous run are examined")
+    parser.add_argument("--jobs", type=int, default=8, metavar="N",
+            help="number of elections examined concurrently")
+    parser.add_argument("--registry", action="store_true",
+            help="read the state of the elections from the registry kept by the server ({} in the spool), instead of examining each election (those it does not know are still examined)".format(REGISTRY_FILE))
+    parser.add_argument("--watch", action="store_true",
+            help="run forever, printing a JSON line each time an election becomes live or stops being live (Linux only)")
+    args = parser.parse_args()
+    verb = args.verbose
+
+    if args.watch:
+        watch(args.spool_directory, max(args.jobs, 1))
+        return
+
+    if args.registry:
+        now = datetime.datetime.now()
+        for uuid, info in sorted(read_registry(args.spool_directory).items()):
+            reason = info.reason(now)
+            if reason != None:
+                verb_print("Election {} is {}".format(uuid, reason))
+                continue
+            print(uuid)
+        return
+
+    index = None
+    if args.cache:
+        index = SpoolIndex(args.cache)
+    cache = SpoolCache(args.spool_directory, index, max(args.jobs, 1))
+    for uuid, reason in cache.scan():
+        if reason != None:
+            verb_print("Election {} is {}".format(uuid, reason))
+            continue
+        print(uuid)
+    verb_print("{} election(s) examined".format(cache.parsed))
+    if index != None:
+        index.close()
+
+if __name__ == "__main__":
+    main()
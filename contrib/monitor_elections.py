@@ -5,28 +5,61 @@ import os
 import sys
 import datetime
 import subprocess
-import urllib.request
 import urllib.error
-import xml.dom.minidom
+import html.parser
+import codecs
+import sqlite3
+import time
+import mmap
+import contextlib
 import re
 import hashlib
 import base64
 import json
+import threading
+import traceback
+import concurrent.futures
+import multiprocessing
+import queue
+import tarfile
+import http_pool
+import chunk_store
+import ballot_verifier
 
 # Example :
 #   ./monitor_elections.py --uuid aTGmQNj1SXA5JG --url https://belenios.loria.fr/beta/ --wdir /tmp/wdir --checkhash yes
+#
+# To poll elections forever, each at a rate depending on its activity:
+#   ./monitor_elections.py --daemon --uuidcommand "list_live_elections.py /path/to/spool" --url https://belenios.loria.fr/beta/ --wdir /tmp/wdir
+#
+# Several elections can be monitored concurrently (8 downloads at a time,
+# and as many verifications as there are cores):
+#   ./monitor_elections.py --uuidfile uuids.txt --jobs 8 --url https://belenios.loria.fr/beta/ --wdir /tmp/wdir
+#
+# For large elections, --stream yes writes the audit files to disk while
+# downloading them (with --incremental, only what was appended to
+# ballots.jsons is downloaded):
+#   ./monitor_elections.py --uuid aTGmQNj1SXA5JG --stream --incremental --url https://belenios.loria.fr/beta/ --wdir /tmp/wdir
+#
+# During the voting phase, --python-verify yes checks only the ballots
+# added since the previous run (faster with gmpy2 installed):
+#   ./monitor_elections.py --uuid aTGmQNj1SXA5JG --python-verify --url https://belenios.loria.fr/beta/ --wdir /tmp/wdir
+#
+# To monitor all the live elections of a server, see also fleet_monitor.py.
 
 
 # External dependencies:
 # - belenios-tool
 # - git
 # - check_hash.py  (from the belenios source dist, in contrib/)
+# - http_pool.py  (idem, to be kept next to this script)
+# - chunk_store.py  (idem)
+# - ballot_verifier.py  (idem)
 
 
 # TODO:
 # - add options --belenios-tool-path and --check-hash-path
 # - find a way to test that failure are detected
-# - do a git gc from time to time or at the end (how?)
 
 
 # The status contains:
@@ -46,16 +79,71 @@ class Status:
 
 # Default output for the logfile is stdout, i.e. None
 log_file = None
+# HTTP connections to the server (see http_pool.py), set in the main part
+pool = None
+# Output of the metrics (see MetricsSink), set in the main part if needed
+metrics_sink = None
+# When several elections are monitored concurrently, each worker thread
+# keeps the log of its election in its own buffer, which is flushed in
+# one piece when the election is done (see flush_log).
+log_buffer = threading.local()
+log_lock = threading.Lock()
 def logme(str):
     msg = "Log: {}".format(str)
-    if log_file == None:
+    lines = getattr(log_buffer, 'lines', None)
+    if lines != None:
+        lines.append((msg, False))
+    elif log_file == None:
         print(msg)
     else:
         print(msg, file=log_file)
 # messages that should also go to stderr:
 def Elogme(str):
     logme(str)
-    print("Log: {}".format(str), file=sys.stderr)
+    lines = getattr(log_buffer, 'lines', None)
+    if lines != None:
+        lines.append(("Log: {}".format(str), True))
+    else:
+        print("Log: {}".format(str), file=sys.stderr)
+
+# What an election carries along the pipeline besides its data: the
+# lines of its log, and the metrics of its stages (see record_metric).
+class Journal:
+    def __init__(self):
+        self.lines = []
+        self.metrics = []
+
+# Record the metrics of a stage of the election being monitored by the
+# current thread: wall time since start, outcome, and if relevant the
+# number of bytes downloaded and of ballots.
+def record_metric(stage, start, fail, nbytes=None, ballots=None):
+    metrics = getattr(log_buffer, 'metrics', None)
+    if metrics == None:
+        return
+    m = { 'stage': stage, 'seconds': round(time.monotonic() - start, 6),
+            'outcome': 'fail' if fail else 'ok' }
+    if nbytes != None:
+        m['bytes'] = nbytes
+    if ballots != None:
+        m['ballots'] = ballots
+    metrics.append(m)
+
+# Called by the HTTP pool after each request
+def count_bytes(method, url, status, nbytes, elapsed):
+    if getattr(log_buffer, 'nbytes', None) != None:
+        log_buffer.nbytes += nbytes
+
+# Write the buffered log of one election; stderr lines are grouped per
+# election so that the summary stays readable.
+def flush_log(lines):
+    with log_lock:
+        for msg, err in lines:
+            if err:
+                print(msg, file=sys.stderr)
+            elif log_file == None:
+                print(msg)
+            else:
+                print(msg, file=log_file)
 
 
 # If it does not exist, create a fresh directory for an election
@@ -77,29 +165,596 @@ audit_files=['election.json', 'public_creds.txt', 'trustees.json',
         'ballots', 'index.html']
 optional_audit_files=['ballots.jsons','result.json','shuffles.jsons']
 
-def download_audit_data(url, uuid):
+# Hash of a ballot, as shown on the ballot-box web page
+def ballot_hash(line):
+    m = hashlib.sha256()
+    m.update(line)
+    return base64.b64encode(m.digest()).decode().strip('=')
+
+# Single-pass extraction of what we need from the web pages (ballot box
+# and index.html), without building a DOM:
+#  - items: the text of each li element
+#  - lists: for each ul with an id, the text of each of its li elements
+#  - codes: the text of each code element
+#  - div_texts: for each div starting with text, this text (up to the
+#    first child element)
+class PageParser(html.parser.HTMLParser):
+    # elements that have no end tag in HTML
+    void_elements = { 'area', 'base', 'br', 'col', 'embed', 'hr', 'img',
+            'input', 'link', 'meta', 'param', 'source', 'track', 'wbr' }
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.items = []
+        self.lists = {}
+        self.codes = []
+        self.div_texts = []
+        # open elements, as [tag, id, text (or None if not needed),
+        # leading text (or None once a child element was seen)]
+        self.stack = []
+
+    def handle_starttag(self, tag, attrs):
+        if self.stack:
+            self.close_leading_text(self.stack[-1])
+        if tag in self.void_elements:
+            return
+        text = [] if tag in ('li', 'code') else None
+        self.stack.append([tag, dict(attrs).get('id'), text, []])
+
+    def handle_startendtag(self, tag, attrs):
+        if self.stack:
+            self.close_leading_text(self.stack[-1])
+
+    def handle_data(self, data):
+        for elt in self.stack:
+            if elt[2] != None:
+                elt[2].append(data)
+        if self.stack and self.stack[-1][3] != None:
+            self.stack[-1][3].append(data)
+
+    # the leading text of an element stops at its first child element
+    def close_leading_text(self, elt):
+        if elt[3] != None:
+            if elt[0] == 'div' and elt[3] != []:
+                self.div_texts.append("".join(elt[3]))
+            elt[3] = None
+
+    def handle_endtag(self, tag):
+        if tag not in [ x[0] for x in self.stack ]:
+            return
+        while True:
+            elt = self.stack.pop()
+            self.close_leading_text(elt)
+            if elt[0] == 'li':
+                text = "".join(elt[2])
+                self.items.append(text)
+                ul = [ x for x in self.stack if x[0] == 'ul' ]
+                if ul != [] and ul[-1][1] != None:
+                    self.lists.setdefault(ul[-1][1], []).append(text)
+            elif elt[0] == 'code':
+                self.codes.append("".join(elt[2]))
+            if elt[0] == tag:
+                return
+
+def parse_page(content, chunk_size=65536):
+    parser = PageParser()
+    decoder = codecs.getincrementaldecoder('utf-8')('replace')
+    for i in range(0, len(content), chunk_size):
+        parser.feed(decoder.decode(content[i:i+chunk_size]))
+    parser.feed(decoder.decode(b'', final=True))
+    parser.close()
+    return parser
+
+# In incremental mode, the HTTP validators (ETag, Last-Modified) of the
+# downloaded audit files are kept in this file of the election directory,
+# together with the hash of the content they refer to. They are used
+# only if the copy of the file in the election directory is still the
+# one that was downloaded with them.
+http_cache_file = 'http_cache.json'
+
+def load_http_cache(p):
+    try:
+        with open(os.path.join(p, http_cache_file), "r") as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return {}
+
+def save_http_cache(p, cache):
+    with open(os.path.join(p, http_cache_file), "w") as file:
+        json.dump(cache, file)
+
+def validators_of_response(resp, content):
+    entry = { 'sha256': hashlib.sha256(content).hexdigest() }
+    if resp.headers.get('ETag') != None:
+        entry['etag'] = resp.headers['ETag']
+    if resp.headers.get('Last-Modified') != None:
+        entry['last_modified'] = resp.headers['Last-Modified']
+    return entry
+
+# Download one audit file, reusing the previous copy prev (or None) when
+# possible: the request is conditional on the validators of prev, and
+# for ballots.jsons only the bytes appended after prev are requested
+# (starting with the last line of prev, which must be unchanged). The
+# assembled ballots.jsons is kept only if the hashes of its lines are
+# exactly those of the ballot-box page; otherwise, the whole file is
+# downloaded again.
+def fetch_audit_file(l, f, uuid, prev, entry, page_hashes):
+    headers = {}
+    if prev != None and entry.get('sha256') == hashlib.sha256(prev).hexdigest():
+        if 'etag' in entry:
+            headers['If-None-Match'] = entry['etag']
+        if 'last_modified' in entry:
+            headers['If-Modified-Since'] = entry['last_modified']
+    if (f == 'ballots.jsons' and prev != None and prev.endswith(b'\n')
+            and page_hashes != None):
+        start = prev.rfind(b'\n', 0, -1) + 1
+        headers['Range'] = 'bytes={}-'.format(start)
+    try:
+        resp = pool.request(l, headers)
+    except urllib.error.HTTPError as e:
+        if e.code == 304 and ('If-None-Match' in headers or
+                'If-Modified-Since' in headers):
+            logme("  {} of {} is unchanged".format(f, uuid))
+            return prev, entry
+        if e.code == 416 and 'Range' in headers:
+            # the file was shortened, so it was not appended to
+            return fetch_audit_file(l, f, uuid, None, {}, None)
+        raise
+    content = resp.read()
+    if resp.status == 206:
+        # Content-Range: bytes first-last/total
+        mat = re.match(r'bytes (\d+)-\d+/(\d+)$',
+                resp.headers.get('Content-Range', ''))
+        assembled = prev[:start] + content
+        if (mat == None or int(mat.group(1)) != start
+                or int(mat.group(2)) != len(assembled)
+                or not content.startswith(prev[start:])
+                or sorted(ballot_hash(x) for x in assembled.splitlines())
+                    != sorted(page_hashes)):
+            logme("  previous {} of {} is not a prefix, downloading it again".format(f, uuid))
+            return fetch_audit_file(l, f, uuid, None, {}, None)
+        logme("  fetched {} new bytes of {} of {}".format(
+            len(assembled) - len(prev), f, uuid))
+        content = assembled
+    return content, validators_of_response(resp, content)
+
+# In streaming mode, the audit files are written to the "new"
+# subdirectory while they are downloaded, instead of being kept in
+# memory. The data dict then maps them to StreamedFile objects, which
+# carry their size, their hash and (for ballots.jsons) the hash of each
+# of their lines, computed on the fly. The hashes of some prefixes are
+# also kept: the one of the complete lines, and those ending at the
+# given marks (the parts of ballots.jsons already covered by the ballot
+# index and the verified cache, see ballots_marks), so that checking
+# that the file only grew does not read it again. The functions below
+# give access to both kinds of data.
+line_hashed_files = ['ballots.jsons', 'shuffles.jsons']
+
+class StreamedFile:
+    def __init__(self, path, line_hashes=False, marks=()):
+        self.path = path
+        self.size = 0
+        self.nlines = 0
+        self.line_hashes = [] if line_hashes else None
+        self.sha256 = None
+        # offset -> hex digest of the bytes before it
+        self.prefix_sha256 = {}
+        self._lines = None
+        self._marks = sorted(set(marks))
+        self._file = open(path, "wb")
+        self._sha = hashlib.sha256()
+        self._line = hashlib.sha256()
+        self._pending = False
+
+    def write(self, chunk):
+        self._file.write(chunk)
+        buf = memoryview(chunk)
+        cuts = [ m - self.size for m in self._marks
+                if self.size <= m <= self.size + len(chunk) ]
+        last = chunk.rfind(b'\n') + 1
+        pos = 0
+        for c in sorted(set(cuts + ([last] if last > 0 else []))):
+            self._sha.update(buf[pos:c])
+            pos = c
+            if c == last:
+                self._lines = (self.size + c, self._sha.hexdigest())
+            if c in cuts:
+                self.prefix_sha256[self.size + c] = self._sha.hexdigest()
+        self._sha.update(buf[pos:])
+        self.size += len(chunk)
+        start = 0
+        while True:
+            i = chunk.find(b'\n', start)
+            if i < 0:
+                break
+            self._line.update(buf[start:i])
+            self._end_line()
+            start = i + 1
+        if start < len(chunk):
+            self._line.update(buf[start:])
+            self._pending = True
+
+    def _end_line(self):
+        self.nlines += 1
+        if self.line_hashes != None:
+            self.line_hashes.append(base64.b64encode(self._line.digest()).decode().strip('='))
+        self._line = hashlib.sha256()
+        self._pending = False
+
+    # append bytes start..end of file path
+    def copy_from(self, path, start=0, end=None):
+        with open(path, "rb") as file:
+            file.seek(start)
+            n = None if end == None else end - start
+            while n == None or n > 0:
+                chunk = file.read(65536 if n == None else min(65536, n))
+                if chunk == b'':
+                    break
+                self.write(chunk)
+                if n != None:
+                    n -= len(chunk)
+
+    def close(self):
+        if self._pending:
+            self._end_line()
+        self._file.close()
+        self.sha256 = self._sha.digest()
+        if self._lines != None:
+            self.prefix_sha256[self._lines[0]] = self._lines[1]
+        self.prefix_sha256[self.size] = self.sha256.hex()
+        # only the results are kept, so that it can be sent to other
+        # processes
+        del self._file, self._sha, self._line, self._lines
+
+    def move(self, path):
+        os.replace(self.path, path)
+        self.path = path
+
+def present(data, f):
+    return f in data and data[f] != b''
+
+def file_content(data, f):
+    if isinstance(data[f], StreamedFile):
+        with open(data[f].path, "rb") as file:
+            return file.read()
+    return data[f]
+
+# Content of f as a buffer, mapped in memory for streamed files
+@contextlib.contextmanager
+def audit_file_buffer(data, f):
+    if isinstance(data[f], StreamedFile) and data[f].size > 0:
+        with open(data[f].path, "rb") as file:
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                yield buf
+    else:
+        yield file_content(data, f)
+
+def file_sha256(data, f):
+    if isinstance(data[f], StreamedFile):
+        return data[f].sha256
+    return hashlib.sha256(data[f]).digest()
+
+# Hex digest of the first size bytes of f
+def prefix_sha256(data, f, size):
+    if not isinstance(data[f], StreamedFile):
+        return hashlib.sha256(memoryview(data[f])[:size]).hexdigest()
+    if size in data[f].prefix_sha256:
+        return data[f].prefix_sha256[size]
+    # not marked while writing
+    m = hashlib.sha256()
+    with open(data[f].path, "rb") as file:
+        while size > 0:
+            chunk = file.read(min(65536, size))
+            if chunk == b'':
+                break
+            m.update(chunk)
+            size -= len(chunk)
+    return m.hexdigest()
+
+def ballots_line_hashes(data):
+    if isinstance(data['ballots.jsons'], StreamedFile):
+        return data['ballots.jsons'].line_hashes
+    return [ ballot_hash(l) for l in data['ballots.jsons'].splitlines() ]
+
+def ballots_count(data):
+    if isinstance(data['ballots.jsons'], StreamedFile):
+        return data['ballots.jsons'].nlines
+    return data['ballots.jsons'].count(b'\n')
+
+def parse_audit_page(data, f):
+    if isinstance(data[f], StreamedFile):
+        parser = PageParser()
+        with open(data[f].path, "r", encoding="utf-8", errors="replace") as file:
+            while True:
+                chunk = file.read(65536)
+                if chunk == '':
+                    break
+                parser.feed(chunk)
+        parser.close()
+        return parser
+    return parse_page(data[f])
+
+def sha256_of_file(path):
+    m = hashlib.sha256()
+    with open(path, "rb") as file:
+        while True:
+            chunk = file.read(65536)
+            if chunk == b'':
+                return m.hexdigest()
+            m.update(chunk)
+
+# Same as fetch_audit_file, but the file is written to dest (through
+# dest.part) instead of being returned; prev is the path of the
+# previous copy, or None, and marks are those of the StreamedFile.
+def fetch_audit_file_to_disk(l, f, uuid, prev, entry, page_hashes, dest,
+        marks=()):
+    headers = {}
+    if prev != None and entry.get('sha256') == sha256_of_file(prev):
+        if 'etag' in entry:
+            headers['If-None-Match'] = entry['etag']
+        if 'last_modified' in entry:
+            headers['If-Modified-Since'] = entry['last_modified']
+    start = None
+    if f == 'ballots.jsons' and prev != None and page_hashes != None:
+        prev_size = os.path.getsize(prev)
+        with open(prev, "rb") as file:
+            file.seek(max(0, prev_size - 65536))
+            tail = file.read()
+        if tail.endswith(b'\n') and tail.rfind(b'\n', 0, -1) >= 0:
+            start = prev_size - len(tail) + tail.rfind(b'\n', 0, -1) + 1
+            headers['Range'] = 'bytes={}-'.format(start)
+    def fallback():
+        return fetch_audit_file_to_disk(l, f, uuid, None, {}, None, dest,
+                marks)
+    part = StreamedFile(dest + ".part", f in line_hashed_files, marks)
+    try:
+        resp = pool.request(l, headers, sink=part.write)
+    except urllib.error.HTTPError as e:
+        part.close()
+        os.remove(part.path)
+        if e.code == 304 and ('If-None-Match' in headers or
+                'If-Modified-Since' in headers):
+            logme("  {} of {} is unchanged".format(f, uuid))
+            out = StreamedFile(dest, f in line_hashed_files, marks)
+            out.copy_from(prev)
+            out.close()
+            return out, entry
+        if e.code == 416 and 'Range' in headers:
+            # the file was shortened, so it was not appended to
+            return fallback()
+        raise
+    except:
+        part.close()
+        os.remove(part.path)
+        raise
+    part.close()
+    validators = validators_of_response(resp, b'')
+    if resp.status == 206:
+        # Content-Range: bytes first-last/total
+        mat = re.match(r'bytes (\d+)-\d+/(\d+)$',
+                resp.headers.get('Content-Range', ''))
+        out = StreamedFile(dest, True, marks)
+        out.copy_from(prev, 0, start)
+        out.copy_from(part.path)
+        out.close()
+        os.remove(part.path)
+        with open(prev, "rb") as file1, open(dest, "rb") as file2:
+            file1.seek(start)
+            file2.seek(start)
+            last = file1.read()
+            same_last = file2.read(len(last)) == last
+        if (mat == None or int(mat.group(1)) != start
+                or int(mat.group(2)) != out.size or not same_last
+                or sorted(out.line_hashes) != sorted(page_hashes)):
+            logme("  previous {} of {} is not a prefix, downloading it again".format(f, uuid))
+            return fallback()
+        logme("  fetched {} new bytes of {} of {}".format(
+            out.size - os.path.getsize(prev), f, uuid))
+    else:
+        out = part
+        out.move(dest)
+    validators['sha256'] = out.sha256.hex()
+    return out, validators
+
+# Archive of all the public files of an election on the server (see
+# election_audit_bundle in src/web/site_voter.ml), with their digests in
+# SHA256SUMS. Downloading it replaces one request per file.
+bundle_file = 'audit.tar.gz'
+
+def read_previous(p, f, stream, marks={}):
+    if stream:
+        out = StreamedFile(os.path.join(p, 'new', f), f in line_hashed_files,
+                marks.get(f, ()))
+        out.copy_from(os.path.join(p, f))
+        out.close()
+        return out
+    with open(os.path.join(p, f), "rb") as file:
+        return file.read()
+
+# Extract the files of the archive in path (in the "new" subdirectory in
+# streaming mode), and check them against SHA256SUMS
+def extract_audit_bundle(path, p, stream, marks={}):
+    files = {}
+    digests = {}
+    sums = None
+    with tarfile.open(path, "r:gz") as tar:
+        for m in tar:
+            src = tar.extractfile(m)
+            if m.name == 'SHA256SUMS':
+                sums = {}
+                for line in src.read().decode().splitlines():
+                    h, f = line.split(maxsplit=1)
+                    sums[f] = h
+                continue
+            f = m.name
+            if f not in audit_files + optional_audit_files or src == None:
+                raise ValueError("unexpected member {}".format(f))
+            if stream:
+                out = StreamedFile(os.path.join(p, 'new', f),
+                        f in line_hashed_files, marks.get(f, ()))
+                try:
+                    while True:
+                        chunk = src.read(65536)
+                        if chunk == b'':
+                            break
+                        out.write(chunk)
+                finally:
+                    out.close()
+                files[f] = out
+                digests[f] = out.sha256.hex()
+            else:
+                files[f] = src.read()
+                digests[f] = hashlib.sha256(files[f]).hexdigest()
+    if sums != digests:
+        raise ValueError("the files do not match SHA256SUMS")
+    return files
+
+# Download the archive of the public files; return the dict of the
+# files it contains (with the same values as in download_audit_data)
+# and its new HTTP cache entry, or None, None if it is not available
+# (older servers, hidden result) or invalid. entry is the previous cache
+# entry, used to make the request conditional when the files it lists
+# are still those of the previous snapshot.
+def fetch_audit_bundle(link, uuid, p, stream, entry, marks={}):
+    headers = {}
+    files = entry.get('files')
+    if files != None and all(os.path.exists(os.path.join(p, f)) and
+            sha256_of_file(os.path.join(p, f)) == h for f, h in files.items()):
+        if 'etag' in entry:
+            headers['If-None-Match'] = entry['etag']
+        if 'last_modified' in entry:
+            headers['If-Modified-Since'] = entry['last_modified']
+    tmp = os.path.join(p, 'new', bundle_file)
+    try:
+        with open(tmp, "wb") as file:
+            resp = pool.request(link + '/' + bundle_file, headers,
+                    sink=file.write)
+        res = extract_audit_bundle(tmp, p, stream, marks)
+    except urllib.error.HTTPError as e:
+        if e.code == 304 and headers != {}:
+            logme("  {} of {} is unchanged".format(bundle_file, uuid))
+            return { f: read_previous(p, f, stream, marks)
+                    for f in files }, entry
+        logme("  {} of {} is not available ({}), downloading the files one by one".format(bundle_file, uuid, e.code))
+        return None, None
+    except (urllib.error.URLError, tarfile.TarError, ValueError, EOFError) as e:
+        logme("  failed to get {} of {} ({}), downloading the files one by one".format(bundle_file, uuid, e))
+        return None, None
+    finally:
+        os.remove(tmp)
+    entry = validators_of_response(resp, b'')
+    del entry['sha256']
+    entry['files'] = { f: file_sha256(res, f).hex() for f in res }
+    return res, entry
+
+# Marks of the StreamedFile objects of the election in p: the offsets in
+# ballots.jsons up to which it was indexed by update_ballot_index, and
+# verified by python_verify_ballots
+def ballots_marks(p):
+    marks = []
+    for name, key in [(ballot_index_file, 'size'),
+            (verified_cache_file, 'snapshot_size')]:
+        if not os.path.exists(os.path.join(p, name)):
+            continue
+        db = sqlite3.connect(os.path.join(p, name))
+        try:
+            row = db.execute("SELECT value FROM meta WHERE key = ?",
+                    (key,)).fetchone()
+        except sqlite3.Error:
+            row = None
+        finally:
+            db.close()
+        if row != None and int(row[0]) > 0:
+            marks.append(int(row[0]))
+    return { 'ballots.jsons': marks }
+
+def download_audit_data(url, uuid, wdir=None, incremental=False,
+        stream=False, bundle=False):
     link = url + '/elections/' + uuid
     data = dict()
     status = Status(False, b"")
     fail = False
     msg = ""
+    if incremental or stream or bundle:
+        p = os.path.join(wdir, uuid)
+    marks = {}
+    if stream:
+        marks = ballots_marks(p)
+    if incremental:
+        cache = load_http_cache(p)
+        new_cache = {}
+    bundled = None
+    if bundle:
+        entry = cache.get(bundle_file, {}) if incremental else {}
+        bundled, entry = fetch_audit_bundle(link, uuid, p, stream, entry,
+                marks)
+        if bundled != None and incremental:
+            new_cache[bundle_file] = entry
+    def fetch(l, f):
+        if stream and not incremental:
+            out = StreamedFile(os.path.join(p, 'new', f),
+                    f in line_hashed_files, marks.get(f, ()))
+            try:
+                pool.request(l, sink=out.write)
+            except:
+                out.close()
+                os.remove(out.path)
+                raise
+            out.close()
+            return out
+        if not incremental:
+            resp = pool.request(l)
+            return resp.read()
+        page_hashes = None
+        if f == 'ballots.jsons' and present(data, 'ballots'):
+            try:
+                page_hashes = parse_audit_page(data, 'ballots').items
+            except Exception:
+                pass
+        if stream:
+            prev = None
+            if os.path.exists(os.path.join(p, f)):
+                prev = os.path.join(p, f)
+            content, new_cache[f] = fetch_audit_file_to_disk(l, f, uuid,
+                    prev, cache.get(f, {}), page_hashes,
+                    os.path.join(p, 'new', f), marks.get(f, ()))
+            return content
+        prev = None
+        if os.path.exists(os.path.join(p, f)):
+            with open(os.path.join(p, f), "rb") as file:
+                prev = file.read()
+        content, new_cache[f] = fetch_audit_file(l, f, uuid, prev,
+                cache.get(f, {}), page_hashes)
+        return content
     for f in audit_files:
+        if bundled != None and f in bundled:
+            data[f] = bundled[f]
+            continue
         try:
             if f == 'index.html':
                 l = link + '/'
             else:
                 l = link + '/' + f
-            resp = urllib.request.urlopen(l)
-            data[f]=resp.read()
+            data[f]=fetch(l, f)
         except urllib.error.URLError as e:
             fail = True
             msg = msg + "Download {} failed with ret code \"{}\" for election {}\n".format(f, e, uuid)
     for f in optional_audit_files:
+        # the archive contains all the files that exist
+        if bundled != None:
+            data[f] = bundled.get(f, b'')
+            continue
         try:
-            resp = urllib.request.urlopen(link + '/' + f)
-            data[f]=resp.read()
+            data[f]=fetch(link + '/' + f, f)
         except:
             data[f]=b''
+    # as with in-memory data, empty files are considered absent
+    for f in data:
+        if isinstance(data[f], StreamedFile) and data[f].size == 0:
+            os.remove(data[f].path)
+            data[f] = b''
+    if incremental:
+        save_http_cache(p, new_cache)
 
     status = Status(fail, msg.encode())
     return status, data
@@ -108,18 +763,47 @@ def download_audit_data(url, uuid):
 # verify-diff.
 # At first, this goes to a 'new' subdirectory, and once verify-diff has
 # been run, this is moved to the main directory of the election.
-def write_and_verify_new_data(wdir, uuid, data):
+# With python_verify, the ballots are checked in Python when possible
+# (see python_verify_ballots).
+def write_and_verify_new_data(wdir, uuid, data, python_verify=False,
+        ballot_jobs=None):
     # copy new data in the "new" subdirectory
     p = os.path.join(wdir, uuid)
     pnew = os.path.join(p, 'new')
     for f in audit_files + optional_audit_files:
-        if data[f] != b'':
+        # streamed files are already there
+        if data[f] != b'' and not isinstance(data[f], StreamedFile):
             with open(os.path.join(pnew, f), "wb") as newf:
                 newf.write(data[f])
 
+    status = None
+    if python_verify:
+        status = python_verify_ballots(p, uuid, data, ballot_jobs)
+    if status == None:
+        status = tool_verify_new_data(p, uuid, data)
+        if python_verify and not status.fail:
+            seed_verified_cache(pnew, data)
+    if status.fail:
+        return status
+
+    # move new files to main subdirectory
+    for f in audit_files + optional_audit_files:
+        if isinstance(data[f], StreamedFile):
+            data[f].move(os.path.join(p, f))
+        elif data[f] != b'':
+            os.rename(os.path.join(pnew, f), os.path.join(p, f))
+    return status
+
+# Run belenios-tool verify and verify-diff on the "new" subdirectory
+def tool_verify_new_data(p, uuid, data):
+    pnew = os.path.join(p, 'new')
+    nballots = ballots_count(data)
+
     # run belenios-tool verify on it
+    start = time.monotonic()
     ver = subprocess.run(["belenios-tool", "verify", "--dir={}".format(pnew)],
             stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    record_metric('verify', start, ver.returncode != 0, ballots=nballots)
     if ver.returncode != 0:
         msg="Error: belenios-tool verify failed on newly downloaded data from election {}, with output {}\n".format(uuid, ver.stdout).encode()
         return Status(True, msg)
@@ -131,35 +815,220 @@ def write_and_verify_new_data(wdir, uuid, data):
     if os.path.exists(os.path.join(p, "fresh")):
         os.remove(os.path.join(p, "fresh"))
     else:
+        start = time.monotonic()
         verdiff = subprocess.run(["belenios-tool", "verify-diff",
             "--dir1={}".format(p), "--dir2={}".format(pnew)],
             stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        record_metric('verify-diff', start, verdiff.returncode != 0,
+                ballots=nballots)
         if verdiff.returncode != 0:
             msg="Error: belenios-tool verify-diff failed on newly downloaded data from election {}, with output {}".format(uuid, verdiff.stdout).encode()
             return Status(True, msg)
         if re.search(b"W:", verdiff.stdout) != None:
             msg = verdiff.stdout
         logme("Successfully diff-verified new data of {}".format(uuid))
+    return Status(False, msg)
 
-    # move new files to main subdirectory
-    for f in audit_files + optional_audit_files:
-        if data[f] != b'':
-            os.rename(os.path.join(pnew, f), os.path.join(p, f))
+# Hashes of the ballots checked by ballot_verifier.py, with their
+# credentials, in the directory of the election
+verified_cache_file = 'verified_ballots.sqlite'
+
+# With --python-verify, when only the ballots have changed since the
+# previous snapshot (that is, during the voting phase), belenios-tool
+# verify and verify-diff, which both check all the ballots, are replaced
+# by the same checks done in Python, where the signatures and proofs are
+# only checked for the ballots that were not seen in a previous run.
+# Return None when this does not apply.
+#
+# The snapshot accepted this way is kept in the verified cache: the
+# credential and hash of each of its ballots (table snapshot), and the
+# stamp of its ballots.jsons, with the size and hash of its content. When
+# the new ballots.jsons starts with this content, only the lines after
+# it are read; otherwise, they are all read, by batches.
+snapshot_batch = 4096
+
+def file_stamp(path):
+    st = os.stat(path)
+    return "{} {} {}".format(st.st_ino, st.st_size, st.st_mtime_ns)
+
+# Lines of buf after offset start, by batches of n
+def line_batches(buf, start=0, n=snapshot_batch):
+    batch = []
+    while start < len(buf):
+        end = buf.find(b'\n', start)
+        if end < 0:
+            end = len(buf)
+        batch.append(buf[start:end])
+        start = end + 1
+        if len(batch) == n:
+            yield batch
+            batch = []
+    if batch != []:
+        yield batch
+
+# Size (or -1 if the last line is not complete) and hash of the content
+# of the snapshot, read from the previous ballots.jsons; None if some of
+# its ballots were not verified
+def rebuild_snapshot(cache, path):
+    cache.db.execute("DELETE FROM snapshot")
+    with open(path, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return 0, hashlib.sha256().hexdigest()
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            for lines in line_batches(buf):
+                hashes = [ ballot_hash(l) for l in lines ]
+                known = cache.lookup(hashes)
+                if len(known) < len(set(hashes)):
+                    return None
+                cache.db.executemany("INSERT OR REPLACE INTO snapshot VALUES (?, ?)",
+                        ( (known[h], h) for h in hashes ))
+            size = len(buf) if buf[-1:] == b'\n' else -1
+            return size, hashlib.sha256(buf).hexdigest()
+
+def python_verify_ballots(p, uuid, data, jobs):
+    if os.path.exists(os.path.join(p, "fresh")):
+        return None
+    for f in ['election.json', 'trustees.json', 'public_creds.txt']:
+        if (not os.path.exists(os.path.join(p, f)) or
+                sha256_of_file(os.path.join(p, f)) != file_sha256(data, f).hex()):
+            return None
+    for f in ['result.json', 'shuffles.jsons']:
+        if present(data, f) or os.path.exists(os.path.join(p, f)):
+            return None
+    if not present(data, 'ballots.jsons'):
+        return None
+    start = time.monotonic()
+    raw = file_content(data, 'election.json')
+    fingerprint = ballot_verifier.Election(raw).fingerprint
+    cache = ballot_verifier.VerifiedCache(os.path.join(p, verified_cache_file),
+            fingerprint)
+    try:
+        res = verify_snapshot(p, data, raw, cache, jobs)
+    finally:
+        cache.close()
+    if res == None:
+        return None
+    err, n, replaced = res
+    record_metric('verify-ballots', start, err != None, ballots=n)
+    if err != None:
+        msg = "Error: ballot verification failed on newly downloaded data from election {}: {}\n".format(uuid, err).encode()
+        return Status(True, msg)
+    logme("Successfully verified {} new ballot(s) of {}{}".format(n, uuid,
+        "" if ballot_verifier.gmpy2 != None else " (without gmpy2)"))
+    msg = b""
+    if replaced > 0:
+        msg = "W: {} ballot(s) have been replaced\n".format(replaced).encode()
     return Status(False, msg)
 
+# Same checks and messages as belenios-tool verify-diff, between the
+# snapshot and the new ballots.jsons; return (error or None, number of
+# ballots checked, number of ballots replaced), or None
+def verify_snapshot(p, data, raw, cache, jobs):
+    db = cache.db
+    db.execute("CREATE TABLE IF NOT EXISTS snapshot (credential TEXT PRIMARY KEY, hash TEXT)")
+    meta = dict(db.execute("SELECT key, value FROM meta"))
+    prev = os.path.join(p, 'ballots.jsons')
+    if not os.path.exists(prev):
+        db.execute("DELETE FROM snapshot")
+        snap = 0, hashlib.sha256().hexdigest()
+    elif meta.get('snapshot') == file_stamp(prev):
+        snap = int(meta['snapshot_size']), meta['snapshot_sha256']
+    else:
+        logme("  reading the previous ballots.jsons")
+        snap = rebuild_snapshot(cache, prev)
+        if snap == None:
+            db.rollback()
+            return None
+        db.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                [ ('snapshot', file_stamp(prev)),
+                  ('snapshot_size', snap[0]), ('snapshot_sha256', snap[1]) ])
+    db.commit()
+
+    pub = set(str(int(x)) for x in
+            file_content(data, 'public_creds.txt').split())
+    db.execute("CREATE TEMP TABLE IF NOT EXISTS current (credential TEXT PRIMARY KEY, hash TEXT)")
+    db.execute("DELETE FROM current")
+    err = None
+    n = 0
+    with contextlib.ExitStack() as stack:
+        buf = stack.enter_context(audit_file_buffer(data, 'ballots.jsons'))
+        # a single pool of processes for all the batches (started only
+        # if some ballots need to be checked)
+        procs = None
+        if jobs > 1:
+            procs = stack.enter_context(ballot_verifier.make_pool(raw, jobs))
+        size = len(buf)
+        # only the lines after the snapshot are new
+        appended = (0 <= snap[0] <= size and
+                prefix_sha256(data, 'ballots.jsons', snap[0]) == snap[1])
+        for lines in line_batches(buf, snap[0] if appended else 0):
+            creds, k = ballot_verifier.verify_ballots(raw, lines, cache, jobs,
+                    procs)
+            n += k
+            for l, cred in zip(lines, creds):
+                h = ballot_hash(l)
+                if cred == None:
+                    err = "invalid ballot {}".format(h)
+                    break
+                try:
+                    db.execute("INSERT INTO current VALUES (?, ?)", (cred, h))
+                except sqlite3.IntegrityError:
+                    err = "duplicate ballot"
+                    break
+                if appended and db.execute("SELECT 1 FROM snapshot WHERE credential = ?",
+                        (cred,)).fetchone() != None:
+                    err = "duplicate ballot"
+                    break
+                if cred not in pub:
+                    err = "ballot signed by invalid key"
+                    break
+            if err != None:
+                break
+        complete = size == 0 or buf[size-1:size] == b'\n'
+    replaced = 0
+    if err == None and not appended:
+        if db.execute("SELECT 1 FROM snapshot WHERE credential NOT IN (SELECT credential FROM current)").fetchone() != None:
+            err = "decreasing ballots"
+        replaced = db.execute("SELECT count(*) FROM snapshot JOIN current USING (credential) WHERE snapshot.hash != current.hash").fetchone()[0]
+    if err == None:
+        # the new ballots.jsons becomes the previous one
+        if not appended:
+            db.execute("DELETE FROM snapshot")
+        db.execute("INSERT OR REPLACE INTO snapshot SELECT credential, hash FROM current")
+        db.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                [ ('snapshot', file_stamp(os.path.join(p, 'new', 'ballots.jsons'))),
+                  ('snapshot_size', size if complete else -1),
+                  ('snapshot_sha256', file_sha256(data, 'ballots.jsons').hex()) ])
+    db.execute("DELETE FROM current")
+    db.commit()
+    return err, n, replaced
+
+# After belenios-tool verify has checked the ballots of pnew, record them
+# as verified, so that the next runs only check the new ones.
+def seed_verified_cache(pnew, data):
+    if not present(data, 'ballots.jsons'):
+        return
+    raw = file_content(data, 'election.json')
+    cache = ballot_verifier.VerifiedCache(
+            os.path.join(os.path.dirname(pnew), verified_cache_file),
+            ballot_verifier.Election(raw).fingerprint)
+    try:
+        # by batches of lines, without reading the whole file in memory
+        with audit_file_buffer(data, 'ballots.jsons') as buf:
+            for lines in line_batches(buf):
+                hashes = [ ballot_hash(l) for l in lines ]
+                known = cache.lookup(hashes)
+                cache.add([ (h, ballot_verifier.ballot_credential(l))
+                    for h, l in zip(hashes, lines) if h not in known ])
+    finally:
+        cache.close()
+
 # Verify that the hash of the ballots shown on the ballot-box web page
 # are consistent with the json file.
-def check_hash_ballots(data):
-    dom = xml.dom.minidom.parseString(data['ballots'])
-    list_ballots = dom.getElementsByTagName("li")
-    list_hash = [ x.firstChild.firstChild.data for x in list_ballots ]
+def check_hash_ballots(uuid, data):
+    list_hash = parse_audit_page(data, 'ballots').items
 
-    list_hash2 = []
-    for l in data['ballots.jsons'].splitlines():
-        m = hashlib.sha256()
-        m.update(l)
-        h = base64.b64encode(m.digest()).decode().strip('=')
-        list_hash2.append(h)
+    list_hash2 = ballots_line_hashes(data)
     list_hash.sort()
     list_hash2.sort()
     if (not list_hash == list_hash2):
@@ -169,13 +1038,145 @@ def check_hash_ballots(data):
         logme("Successfully checked hash of ballots of {}".format(uuid))
         return Status(False, b"")
 
+# Persistent index of the ballots of an election, kept in its directory:
+# the hash of each line of ballots.jsons, together with the number of
+# bytes of ballots.jsons that were indexed and the hash of these bytes.
+# When ballots.jsons only grew since the previous run, only the new lines
+# are read (in streaming mode, the hash of the indexed bytes is computed
+# while downloading, see StreamedFile); when it was rewritten otherwise,
+# the index is rebuilt. Only complete lines are indexed; a last line
+# without trailing newline is hashed on each run.
+ballot_index_file = 'ballots_index.sqlite'
+
+def open_ballot_index(p):
+    db = sqlite3.connect(os.path.join(p, ballot_index_file))
+    db.execute("CREATE TABLE IF NOT EXISTS ballots (hash TEXT PRIMARY KEY)")
+    db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)")
+    return db
+
+# Update the index with the content of ballots.jsons in data; return the
+# number of lines and the hash of the last line if it is not indexed.
+def update_ballot_index(db, data):
+    meta = dict(db.execute("SELECT key, value FROM meta"))
+    size = meta.get('size', 0)
+    line_hashes = None
+    if isinstance(data['ballots.jsons'], StreamedFile):
+        line_hashes = data['ballots.jsons'].line_hashes
+    with audit_file_buffer(data, 'ballots.jsons') as ballots:
+        if size <= len(ballots) and (size == 0 or
+                prefix_sha256(data, 'ballots.jsons', size) == meta.get('sha256')):
+            nlines = meta.get('lines', 0)
+        else:
+            logme("  ballots.jsons was rewritten, rebuilding the index")
+            db.execute("DELETE FROM ballots")
+            size = 0
+            nlines = 0
+        end = ballots.rfind(b'\n') + 1
+        if end > size:
+            tail = ballots[size:end]
+            if line_hashes != None:
+                new = line_hashes[nlines:nlines+tail.count(b'\n')]
+            else:
+                new = [ ballot_hash(l) for l in tail.splitlines() ]
+            del tail
+            db.executemany("INSERT OR IGNORE INTO ballots VALUES (?)",
+                    ( (h,) for h in new ))
+            nlines += len(new)
+            db.executemany("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                    [ ('size', end),
+                      ('sha256', prefix_sha256(data, 'ballots.jsons', end)),
+                      ('lines', nlines) ])
+            logme("  indexed {} new ballot(s)".format(len(new)))
+        db.commit()
+        if end < len(ballots):
+            if line_hashes != None:
+                return nlines + 1, line_hashes[-1]
+            return nlines + 1, ballot_hash(ballots[end:])
+    return nlines, None
+
+# Same as check_hash_ballots, using the index of the ballots
+def check_hash_ballots_index(wdir, uuid, data):
+    db = open_ballot_index(os.path.join(wdir, uuid))
+    try:
+        nlines, last = update_ballot_index(db, data)
+        list_hash = parse_audit_page(data, 'ballots').items
+        db.execute("CREATE TEMP TABLE page (hash TEXT)")
+        db.executemany("INSERT INTO page VALUES (?)",
+                ( (h,) for h in list_hash ))
+        if last != None:
+            db.execute("INSERT OR IGNORE INTO ballots VALUES (?)", (last,))
+        # ballots shown on the page but not in ballots.jsons, and
+        # conversely
+        missing = db.execute("SELECT hash FROM page EXCEPT SELECT hash FROM ballots").fetchall()
+        unknown = db.execute("SELECT hash FROM ballots EXCEPT SELECT hash FROM page").fetchall()
+        # not committed: the unindexed last line is forgotten
+        db.rollback()
+    finally:
+        db.close()
+    if missing != [] or unknown != [] or nlines != len(list_hash):
+        msg = b"Error: hash of ballots do not correspond!\n"
+        return Status(True, msg)
+    else:
+        logme("Successfully checked hash of ballots of {}".format(uuid))
+        return Status(False, b"")
+
+# The fingerprints of the encrypted tally and of the shuffles are hashes
+# of their JSON serialization, as written by the server. Instead of
+# decoding and re-encoding them (which is slow for the big integers of
+# the shuffles), their exact bytes are located in the files and hashed.
+# Tokens that matter to find the bounds of the values: strings (which
+# are skipped as a whole) and punctuation.
+JSON_TOKEN = re.compile(rb'"(?:[^"\\]|\\.)*"|[{}\[\],:]')
+JSON_SPACE = b' \t\r\n'
+
+def strip_span(buf, start, end):
+    while start < end and buf[start] in JSON_SPACE:
+        start += 1
+    while end > start and buf[end-1] in JSON_SPACE:
+        end -= 1
+    return start, end
+
+# Byte spans of the members of the object (if obj) or of the elements of
+# the array in buf[start:end]: a list of (key or None, start, end).
+def json_spans(buf, start=0, end=None, obj=True):
+    if end == None:
+        end = len(buf)
+    spans = []
+    depth = 0
+    key = None
+    vstart = None
+    for mat in JSON_TOKEN.finditer(buf, start, end):
+        t = buf[mat.start()]
+        if depth == 1:
+            if t == ord('"') and obj and vstart == None:
+                key = json.loads(buf[mat.start():mat.end()])
+            elif t == ord(':'):
+                vstart = mat.end()
+            elif t in b',}]':
+                if vstart != None:
+                    s, e = strip_span(buf, vstart, mat.start())
+                    if s < e:
+                        spans.append((key, s, e))
+                vstart = None if obj else mat.end()
+                if t != ord(','):
+                    return spans
+        if t in b'{[':
+            if depth == 0:
+                vstart = None if obj else mat.end()
+            depth += 1
+        elif t in b'}]':
+            depth -= 1
+    raise ValueError("truncated JSON value")
+
+def sha256_b64_span(buf, start, end):
+    with memoryview(buf) as view:
+        m = hashlib.sha256(view[start:end])
+    return base64.b64encode(m.digest()).decode().strip('=')
+
 # Verify that the data printed on the page of the election is
 # consistent with the other audit files.
-def check_index_html(data):
-    # when the election is closed, there is a "disabled" attributed
-    # without value that the xml parser does not like. We remove it.
-    st = data['index.html'].decode().replace('disabled>Start', '>Start')
-    dom = xml.dom.minidom.parseString(st)
+def check_index_html(uuid, data):
+    page = parse_audit_page(data, 'index.html')
     fail = False
     msg = b""
 
@@ -183,9 +1184,9 @@ def check_index_html(data):
 
     # fingerprint of the election vs election.json
     m = hashlib.sha256()
-    m.update(data['election.json'][0:-1]) # remove trailing \n
+    m.update(file_content(data, 'election.json')[0:-1]) # remove trailing \n
     h = base64.b64encode(m.digest()).decode().strip('=')
-    h2 = dom.getElementsByTagName("code")[0].firstChild.data
+    h2 = page.codes[0]
     if (not h == h2):
         msg = "Error: Wrong fingerprint of election {}\n".format(uuid).encode()
         fail = True
@@ -193,15 +1194,11 @@ def check_index_html(data):
         logme("  election fingerprint ok")
 
     # credential fingerprint vs public_creds.txt
-    m = hashlib.sha256()
-    m.update(data['public_creds.txt']) 
-    h = base64.b64encode(m.digest()).decode().strip('=')
-    node = [ x.firstChild for x in dom.getElementsByTagName("div")
-            if x.firstChild != None and
-            x.firstChild.nodeType == xml.dom.minidom.Node.TEXT_NODE and
-            re.search("Credentials were generated",x.firstChild.data) != None ]
+    h = base64.b64encode(file_sha256(data, 'public_creds.txt')).decode().strip('=')
+    node = [ x for x in page.div_texts
+            if re.search("Credentials were generated", x) != None ]
     assert len(node) == 1
-    h2 = node[0].data.split(' ')[-1].strip('.')
+    h2 = node[0].split(' ')[-1].strip('.')
     if (not h == h2):
         msg = msg + "Error: Wrong credential fingerprint of election {}\n".format(uuid).encode()
         fail = True
@@ -216,7 +1213,7 @@ def check_index_html(data):
         return base64.b64encode(m.digest()).decode().strip('=')
 
     # trustees fingerprint vs trustees.json
-    jsn = json.loads(data['trustees.json'])
+    jsn = json.loads(file_content(data, 'trustees.json'))
     names = []
     hashs = []
     for trustee in jsn:
@@ -238,10 +1235,7 @@ def check_index_html(data):
     names2 = []
     hashs2 = []
     # in index.html, the trustees are in the ul list with id "trustees"
-    for trustee in [ x for x in dom.getElementsByTagName("ul") if
-            x.getAttribute('id') == 'trustees'
-            ][0].getElementsByTagName("li"):
-        s = trustee.firstChild.data
+    for s in page.lists.get('trustees', []):
         mat = pat.match(s)
         names2.append(mat.group(1))
         hashs2.append(mat.group(2))
@@ -261,10 +1255,7 @@ def check_index_html(data):
         names2 = []
         hashs2 = []
         # in index.html, the PKI are in the ul list with id "pki"
-        for trustee in [ x for x in dom.getElementsByTagName("ul") if
-                x.getAttribute('id') == 'pki'
-                ][0].getElementsByTagName("li"):
-            s = trustee.firstChild.data
+        for s in page.lists.get('pki', []):
             mat = pat.match(s)
             names2.append(mat.group(1))
             hashs2.append(mat.group(2))
@@ -276,51 +1267,38 @@ def check_index_html(data):
 
     # encrypted tally vs result.json (if present)
     # (and extract shuffles if present)
-    shuf_array = None
+    hashs = None
     if data['result.json'] != b'':
-        jsn = json.loads(data['result.json'])
-        if 'encrypted_tally' in jsn:
-            s = jsn['encrypted_tally']
-            # convert to a string as Belenios use it for hashing
-            ss = json.JSONEncoder().encode(s).replace(' ', '')
-            m = hashlib.sha256()
-            m.update(ss.encode())
-            h = base64.b64encode(m.digest()).decode().strip('=')
-            node = [ x.firstChild for x in dom.getElementsByTagName("div") if
-                    x.firstChild != None and x.firstChild.nodeType ==
-                    xml.dom.minidom.Node.TEXT_NODE and
-                    re.search("The fingerprint of the encrypted tally",
-                        x.firstChild.data) != None ]
-            assert len(node) == 1
-            h2 = node[0].data.split(' ')[-1].strip('.')
-            if (not h == h2):
-                msg = msg + "Error: Wrong encrypted tally fingerprint of election {}\n".format(uuid).encode()
-                fail = True
-            else:
-                logme("  encrypted tally fingerprint ok")
-        if 'shuffles' in jsn:
-            shuf_array=jsn['shuffles']
+        with audit_file_buffer(data, 'result.json') as buf:
+            spans = { k: (s, e) for k, s, e in json_spans(buf) }
+            if 'encrypted_tally' in spans:
+                h = sha256_b64_span(buf, *spans['encrypted_tally'])
+                node = [ x for x in page.div_texts if
+                        re.search("The fingerprint of the encrypted tally",
+                            x) != None ]
+                assert len(node) == 1
+                h2 = node[0].split(' ')[-1].strip('.')
+                if (not h == h2):
+                    msg = msg + "Error: Wrong encrypted tally fingerprint of election {}\n".format(uuid).encode()
+                    fail = True
+                else:
+                    logme("  encrypted tally fingerprint ok")
+            if 'shuffles' in spans and buf[spans['shuffles'][0]] == ord('['):
+                hashs = [ sha256_b64_span(buf, s, e) for _, s, e in
+                        json_spans(buf, *spans['shuffles'], obj=False) ]
     elif data['shuffles.jsons'] != b'':
         # not exactly the same as in result.json: one json per line...
-        shuf_array = []
-        for line in data['shuffles.jsons'].decode().splitlines():
-            shuf_array.append(json.loads(line))
-    
+        if isinstance(data['shuffles.jsons'], StreamedFile):
+            hashs = data['shuffles.jsons'].line_hashes
+        else:
+            hashs = [ ballot_hash(l) for l in
+                    data['shuffles.jsons'].splitlines() ]
+
     # shuffles fingerprint vs result.json or shuffles.jsons (if present)
-    if shuf_array != None:
-        hashs = []
+    if hashs != None:
         hashs2 = []
-        for s in shuf_array:
-            # convert to a string as Belenios use it for hashing
-            ss = json.JSONEncoder().encode(s).replace(' ', '')
-            m = hashlib.sha256()
-            m.update(ss.encode())
-            hashs.append(base64.b64encode(m.digest()).decode().strip('='))
         # in index.html, the shuffles are in the ul with id 'shuffles'
-        for shuf in [ x for x in dom.getElementsByTagName("ul") if
-                x.getAttribute('id') == 'shuffles'
-                ][0].getElementsByTagName("li"):
-            s = shuf.firstChild.data
+        for s in page.lists.get('shuffles', []):
             # reuse same pattern as for trustees
             mat = pat.match(s)
             hashs2.append(mat.group(2))
@@ -335,10 +1313,10 @@ def check_index_html(data):
     return Status(fail, msg)
 
 
-def commit(wdir, uuid, msg):
+def commit(wdir, uuid, data, msg):
     eldir = os.path.join(wdir, uuid)
     for f in audit_files + optional_audit_files:
-        if f in data.keys() and data[f] != b'':
+        if present(data, f):
             gitadd = subprocess.run(["git",
                 "-C", eldir, "add", f])
             if gitadd.returncode != 0:
@@ -350,11 +1328,481 @@ def commit(wdir, uuid, msg):
         "commit", "-q", "--allow-empty", "--allow-empty-message",
         "-m",  msg.decode()])
     if gitci.returncode != 0:
-        Elogme("Failed git commit {} for election {}".format(f, uuid))
+        Elogme("Failed git commit for election {}".format(uuid))
         return False
     logme("Successfully added a commit for {}".format(uuid))
     return True
 
+# Alternative to commit(): the snapshot is written with a single
+# `git fast-import` process instead of one `git add` per file and a `git
+# commit`. As with `git add`, the files committed are those of the
+# election directory (which are the new ones only if they were
+# verified). The objects are written directly in a pack, and the git
+# index is then reset to the new commit (`git read-tree`), so that both
+# methods can be used on the same repository.
+committer_ident = None
+
+def git_head(eldir):
+    with open(os.path.join(eldir, ".git", "HEAD"), "r") as file:
+        head = file.read().strip()
+    assert head.startswith("ref: ")
+    ref = head[5:]
+    parent = None
+    try:
+        with open(os.path.join(eldir, ".git", ref), "r") as file:
+            parent = file.read().strip()
+    except FileNotFoundError:
+        try:
+            with open(os.path.join(eldir, ".git", "packed-refs"), "r") as file:
+                for line in file:
+                    if line.rstrip("\n").endswith(" " + ref):
+                        parent = line.split(" ")[0]
+        except FileNotFoundError:
+            pass
+    return ref, parent
+
+def commit_fast_import(wdir, uuid, data, msg):
+    global committer_ident
+    eldir = os.path.join(wdir, uuid)
+    if committer_ident == None:
+        # "Name <email> timestamp tz", we keep "Name <email>"
+        ident = subprocess.run(["git", "-C", eldir, "var", "GIT_COMMITTER_IDENT"],
+                stdout=subprocess.PIPE)
+        committer_ident = ident.stdout.decode().rsplit(" ", 2)[0]
+    ref, parent = git_head(eldir)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    stream = [ "commit {}\n".format(ref).encode(),
+            "committer {} {} +0000\n".format(committer_ident,
+                int(now.timestamp())).encode(),
+            "data {}\n".format(len(msg)).encode(), msg, b"\n" ]
+    if parent != None:
+        stream.append("from {}\n".format(parent).encode())
+    for f in audit_files + optional_audit_files:
+        if present(data, f):
+            try:
+                with open(os.path.join(eldir, f), "rb") as file:
+                    content = file.read()
+            except OSError:
+                Elogme("Failed git add {} for election {}".format(f, uuid))
+                return False
+            stream += [ "M 100644 inline {}\n".format(f).encode(),
+                    "data {}\n".format(len(content)).encode(), content, b"\n" ]
+    gitfi = subprocess.run(["git", "-C", eldir,
+        "-c", "fastimport.unpackLimit=0", "fast-import", "--quiet"],
+            input=b"".join(stream), stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT)
+    if gitfi.returncode != 0:
+        Elogme("Failed git fast-import for election {}: {}".format(uuid,
+            gitfi.stdout.decode()))
+        return False
+    gitrt = subprocess.run(["git", "-C", eldir, "read-tree", "HEAD"])
+    if gitrt.returncode != 0:
+        Elogme("Failed git read-tree for election {}".format(uuid))
+        return False
+    logme("Successfully added a commit for {}".format(uuid))
+    return True
+
+# Alternative to git: the snapshot is recorded in a content-addressed
+# store of chunks in the election directory (see chunk_store.py), where
+# the unchanged parts of the files are stored only once.
+def commit_chunks(wdir, uuid, data, msg, fail):
+    eldir = os.path.join(wdir, uuid)
+    files = {}
+    for f in audit_files + optional_audit_files:
+        if present(data, f):
+            try:
+                with open(os.path.join(eldir, f), "rb") as file:
+                    files[f] = file.read()
+            except OSError:
+                Elogme("Failed to archive {} for election {}".format(f, uuid))
+                return False
+    store = chunk_store.ChunkStore(eldir)
+    n, new = store.add_snapshot(files, msg.decode(), fail)
+    logme("Successfully added snapshot {} for {} ({} new bytes)".format(n,
+        uuid, new))
+    return True
+
+# Each run adds a pack to the git repository of the election when
+# fast-import is used (and loose objects otherwise). Once the election
+# has at least gc_packs packs or 1000 loose objects, `git gc` gathers
+# them in a single delta-compressed pack.
+def maybe_gc(wdir, uuid, gc_packs):
+    objects = os.path.join(wdir, uuid, ".git", "objects")
+    try:
+        packs = len([ x for x in os.listdir(os.path.join(objects, "pack"))
+            if x.endswith(".pack") ])
+        loose = sum(len(os.listdir(os.path.join(objects, x)))
+                for x in os.listdir(objects) if len(x) == 2)
+    except OSError:
+        return
+    if packs >= gc_packs or loose >= 1000:
+        gc = subprocess.run(["git", "-C", os.path.join(wdir, uuid), "gc",
+            "--quiet"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        if gc.returncode != 0:
+            Elogme("Failed git gc for election {}: {}".format(uuid,
+                gc.stdout.decode()))
+        else:
+            logme("Garbage-collected the git repository of {}".format(uuid))
+
+# The elections are monitored by a pipeline of three stages, so that
+# the network, the CPU and the disk are used at the same time:
+#  - download (network-bound): args.jobs threads
+#  - verification with belenios-tool and checks of the web pages
+#    (CPU-bound): a pool of args.verify_jobs processes
+#  - commit in the git repository of the election (disk-bound): the
+#    main thread
+# The stages are connected by bounded queues, so that at most a few
+# downloaded elections wait in memory for the next stage. Each election
+# carries along its Status and the list of its log lines, which are
+# written when it leaves the pipeline.
+
+# Run f(*a) with the log and metrics going to journal; an unexpected
+# exception only fails the current election.
+def run_logged(journal, uuid, f, *a):
+    log_buffer.lines = journal.lines
+    log_buffer.metrics = journal.metrics
+    try:
+        return f(*a)
+    except Exception:
+        Elogme("Monitoring of election {} crashed:\n{}".format(uuid,
+            traceback.format_exc()))
+        return None
+    finally:
+        log_buffer.lines = None
+        log_buffer.metrics = None
+
+def download_stage(wdir, url, uuid, incremental, stream, bundle):
+    logme("Start monitoring election {}".format(uuid))
+    check_or_create_dir(wdir, uuid)
+    start = time.monotonic()
+    log_buffer.nbytes = 0
+    try:
+        status, data = download_audit_data(url, uuid, wdir, incremental,
+                stream, bundle)
+        record_metric('download', start, status.fail, nbytes=log_buffer.nbytes)
+    finally:
+        log_buffer.nbytes = None
+    return status, data
+
+def verify_stage(wdir, uuid, data, ballot_index, python_verify, ballot_jobs):
+    status = write_and_verify_new_data(wdir, uuid, data, python_verify,
+            ballot_jobs)
+    start = time.monotonic()
+    if ballot_index:
+        stat = check_hash_ballots_index(wdir, uuid, data)
+    else:
+        stat = check_hash_ballots(uuid, data)
+    record_metric('check_hash_ballots', start, stat.fail,
+            ballots=ballots_count(data))
+    status.merge(stat)
+    start = time.monotonic()
+    stat = check_index_html(uuid, data)
+    record_metric('check_index_html', start, stat.fail)
+    status.merge(stat)
+    return status
+
+# Entry point of the verification processes
+def verify_job(wdir, uuid, data, ballot_index, python_verify, ballot_jobs):
+    journal = Journal()
+    status = run_logged(journal, uuid, verify_stage, wdir, uuid, data,
+            ballot_index, python_verify, ballot_jobs)
+    if status == None:
+        status = Status(True, b"")
+    return status, journal
+
+def commit_stage(wdir, uuid, data, status, archive, gc_packs):
+    start = time.monotonic()
+    if status.msg != b'':
+        Elogme("Commit log for election {} is {}".format(uuid,
+            status.msg.decode()))
+    if archive == 'git-fast-import':
+        ok = commit_fast_import(wdir, uuid, data, status.msg)
+    elif archive == 'chunks':
+        ok = commit_chunks(wdir, uuid, data, status.msg, status.fail)
+    else:
+        ok = commit(wdir, uuid, data, status.msg)
+    if not ok:
+        status.merge(Status(True, b""))
+    record_metric('commit', start, not ok)
+    if gc_packs > 0 and archive != 'chunks':
+        maybe_gc(wdir, uuid, gc_packs)
+    return status
+
+# Monitor all the elections of uuids; return the list of those that
+# failed. If given, on_done(uuid, status, data) is called in the main
+# thread when an election leaves the pipeline.
+def monitor_elections(args, uuids, on_done=None):
+    url = args.url.strip("/")
+    todo = queue.Queue()
+    for uuid in uuids:
+        todo.put(uuid)
+    downloaded = queue.Queue(maxsize=args.verify_jobs)
+    verified = queue.Queue(maxsize=args.verify_jobs)
+    done = object()
+    # the processes checking the ballots are shared among the elections
+    # verified concurrently
+    ballot_jobs = max(1, args.ballot_jobs // args.verify_jobs)
+
+    def downloader():
+        while True:
+            try:
+                uuid = todo.get_nowait()
+            except queue.Empty:
+                return
+            journal = Journal()
+            res = run_logged(journal, uuid, download_stage, args.wdir, url,
+                    uuid, args.incremental, args.stream, args.bundle)
+            if res == None:
+                res = Status(True, b""), {}
+            downloaded.put((uuid, res[0], res[1], journal))
+
+    def verifier(procs):
+        while True:
+            item = downloaded.get()
+            if item is done:
+                return
+            uuid, status, data, journal = item
+            # if we managed to download stuff, then check what we can
+            if not status.fail:
+                try:
+                    stat, vjournal = procs.submit(verify_job, args.wdir, uuid,
+                            data, args.ballot_index, args.python_verify,
+                            ballot_jobs).result()
+                except Exception as e:
+                    stat, vjournal = Status(True, b""), Journal()
+                    vjournal.lines.append(("Log: Verification of election {} failed: {}".format(uuid, e), True))
+                journal.lines.extend(vjournal.lines)
+                journal.metrics.extend(vjournal.metrics)
+                status.merge(stat)
+            verified.put((uuid, status, data, journal))
+
+    def run(threads):
+        for t in threads:
+            t.start()
+        return threads
+
+    # processes are spawned, not forked, since other threads are running
+    ctx = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(args.verify_jobs,
+            mp_context=ctx) as procs:
+        downloaders = run([ threading.Thread(target=downloader)
+            for i in range(min(args.jobs, max(len(uuids), 1))) ])
+        verifiers = run([ threading.Thread(target=verifier, args=(procs,))
+            for i in range(args.verify_jobs) ])
+        def close_stages():
+            for t in downloaders:
+                t.join()
+            for t in verifiers:
+                downloaded.put(done)
+            for t in verifiers:
+                t.join()
+            verified.put(done)
+        closer = run([ threading.Thread(target=close_stages) ])
+
+        failed = []
+        while True:
+            item = verified.get()
+            if item is done:
+                break
+            uuid, status, data, journal = item
+            if run_logged(journal, uuid, commit_stage, args.wdir, uuid, data,
+                    status, args.archive, args.gc_packs) == None:
+                status.merge(Status(True, b""))
+            flush_log(journal.lines)
+            if metrics_sink != None:
+                metrics_sink.add(uuid, status, journal.metrics)
+            if status.fail:
+                failed.append(uuid)
+            if on_done != None:
+                on_done(uuid, status, data)
+        closer[0].join()
+    return failed
+
+# Output of the metrics of the stages of each election:
+#  - as JSON lines appended to jsonl_file, one per stage and election
+#  - in the format of the textfile collector of the Prometheus node
+#    exporter, rewritten in prom_file after each run (or each cycle in
+#    daemon mode) with the latest metrics of each election and stage
+class MetricsSink:
+    def __init__(self, jsonl_file, prom_file):
+        self.jsonl_file = jsonl_file
+        self.prom_file = prom_file
+        # (uuid, stage) -> latest metrics
+        self.latest = {}
+        # uuid -> 1 if the latest run failed, 0 otherwise
+        self.failed = {}
+
+    def add(self, uuid, status, metrics):
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        if self.jsonl_file != None:
+            with open(self.jsonl_file, "a") as file:
+                for m in metrics:
+                    line = dict(time=now, uuid=uuid)
+                    line.update(m)
+                    print(json.dumps(line), file=file)
+        for m in metrics:
+            self.latest[(uuid, m['stage'])] = m
+        self.failed[uuid] = 1 if status.fail else 0
+
+    # Forget the elections that are not in uuids (in daemon mode, those
+    # that are no longer monitored); return True if there were some
+    def keep(self, uuids):
+        old = [ u for u in self.failed if u not in uuids ]
+        for u in old:
+            del self.failed[u]
+        for k in [ k for k in self.latest if k[0] not in uuids ]:
+            del self.latest[k]
+        return old != []
+
+    def write_prom(self):
+        if self.prom_file == None:
+            return
+        out = []
+        def metric(name, help, values):
+            out.append("# HELP belenios_monitor_{} {}".format(name, help))
+            out.append("# TYPE belenios_monitor_{} gauge".format(name))
+            for labels, v in values:
+                out.append("belenios_monitor_{}{{{}}} {}".format(name,
+                    ",".join('{}="{}"'.format(k, x) for k, x in labels), v))
+        items = sorted(self.latest.items())
+        metric("stage_seconds", "Wall time of the latest run of a stage.",
+                [ ((('uuid', u), ('stage', st)), m['seconds'])
+                    for (u, st), m in items ])
+        metric("stage_success", "Whether the latest run of a stage succeeded.",
+                [ ((('uuid', u), ('stage', st)), int(m['outcome'] == 'ok'))
+                    for (u, st), m in items ])
+        metric("stage_bytes", "Bytes downloaded by the latest run of a stage.",
+                [ ((('uuid', u), ('stage', st)), m['bytes'])
+                    for (u, st), m in items if 'bytes' in m ])
+        metric("stage_ballots", "Number of ballots seen by the latest run of a stage.",
+                [ ((('uuid', u), ('stage', st)), m['ballots'])
+                    for (u, st), m in items if 'ballots' in m ])
+        metric("election_failed", "Whether the latest monitoring of an election failed.",
+                [ ((('uuid', u),), f) for u, f in sorted(self.failed.items()) ])
+        metric("last_run_timestamp_seconds", "Time of the end of the latest run.",
+                [ ((), int(time.time())) ])
+        # the collector must never read a partially written file
+        tmp = self.prom_file + ".tmp"
+        with open(tmp, "w") as file:
+            file.write("\n".join(out) + "\n")
+        os.replace(tmp, self.prom_file)
+
+# Daemon mode: instead of monitoring all the elections once, poll each
+# election at its own rate, forever. An election whose ballots.jsons
+# changed since its previous poll is polled again after min_interval;
+# otherwise (no new ballot, closed or tallied election), the delay is
+# doubled, up to max_interval. A failure does not change the delay. The
+# list of elections is read again before each cycle, so that elections
+# can be added or removed without restarting.
+class Scheduler:
+    def __init__(self, min_interval, max_interval):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        # uuid -> [time of next poll, delay, hash of ballots.jsons]
+        self.elections = {}
+
+    def update_uuids(self, uuids):
+        now = time.monotonic()
+        for uuid in uuids:
+            if uuid not in self.elections:
+                logme("New election to monitor: {}".format(uuid))
+                self.elections[uuid] = [now, self.min_interval, None]
+        for uuid in list(self.elections):
+            if uuid not in uuids:
+                logme("Election no longer monitored: {}".format(uuid))
+                del self.elections[uuid]
+
+    def due(self):
+        now = time.monotonic()
+        return [ uuid for uuid, e in self.elections.items() if e[0] <= now ]
+
+    # delay before the next election is due
+    def wait_time(self):
+        if self.elections == {}:
+            return self.min_interval
+        now = time.monotonic()
+        return max(0, min(e[0] for e in self.elections.values()) - now)
+
+    def done(self, uuid, status, data):
+        e = self.elections.get(uuid)
+        if e == None:
+            return
+        h = None
+        if 'ballots.jsons' in data:
+            h = file_sha256(data, 'ballots.jsons').hex()
+        if status.fail:
+            pass
+        elif h != e[2] and data.get('result.json', b'') == b'':
+            e[1] = self.min_interval
+        else:
+            e[1] = min(2 * e[1], self.max_interval)
+        if not status.fail:
+            e[2] = h
+        e[0] = time.monotonic() + e[1]
+        logme("Next poll of {} in {}s".format(uuid, e[1]))
+
+def read_uuids(args):
+    if args.uuid:
+        return [ args.uuid ]
+    if args.uuidcommand:
+        out = subprocess.run(args.uuidcommand, shell=True, check=True,
+                stdout=subprocess.PIPE).stdout.decode()
+        return [ x.strip() for x in out.splitlines() if x.strip() != '' ]
+    uuids = [ ]
+    with open(args.uuidfile, "r") as file:
+        for line in file:
+            uuids.append(line.rstrip())
+    return uuids
+
+def check_static_files(args):
+    hh = subprocess.run(["check_hash.py", "--url", args.url ],
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    if hh.returncode != 0:
+        print(hh.stdout.decode())
+        return False
+    logme("Successfully checked hash of static files")
+    return True
+
+# read: function returning the list of elections to monitor (read_uuids,
+# or the discovery of fleet_monitor.py); done: if not None, function
+# called after each election like the on_done of monitor_elections;
+# report: if not None, function called after each cycle with the polled
+# and the failed elections
+def run_daemon(args, read=read_uuids, done=None, report=None):
+    sched = Scheduler(args.min_interval, args.max_interval)
+    def on_done(uuid, status, data):
+        sched.done(uuid, status, data)
+        if done != None:
+            done(uuid, status, data)
+    while True:
+        try:
+            sched.update_uuids(read(args))
+        except (OSError, subprocess.CalledProcessError) as e:
+            Elogme("Failed to read the list of elections: {}".format(e))
+        dropped = (metrics_sink != None and
+                metrics_sink.keep(sched.elections))
+        due = sched.due()
+        if due != []:
+            logme("[{}] Polling {} election(s).".format(datetime.datetime.now(),
+                len(due)))
+            failed = monitor_elections(args, due, on_done)
+            if failed != []:
+                Elogme("{} election(s) out of {} failed: {}".format(
+                    len(failed), len(due), " ".join(failed)))
+            if report != None:
+                report(due, failed)
+            if args.checkhash == True:
+                check_static_files(args)
+            logme("HTTP: " + pool.report(reset=True).splitlines()[-1])
+            if metrics_sink != None:
+                metrics_sink.write_prom()
+            if log_file != None:
+                log_file.flush()
+        elif dropped:
+            metrics_sink.write_prom()
+        # wake up at least every min_interval to read the list again
+        time.sleep(min(sched.wait_time(), args.min_interval))
+
 #############################################
 
 # Parsing a bool is not a built-in of argparse :-(
@@ -369,75 +1817,127 @@ def str2bool(v):
     else:
         raise argparse.ArgumentTypeError('Boolean value expected.')
 
-parser = argparse.ArgumentParser(description="monitor Belenios elections")
-group = parser.add_mutually_exclusive_group(required=True)
-group.add_argument("--uuidfile", help="file containing uuid's of election to monitor")
-group.add_argument("--uuid", help="uuid of an election to monitor")
-parser.add_argument("--url", required=True, help="prefix url (without trailing /elections )")
-parser.add_argument("--wdir", required=True, help="work dir where logs are kept")
-parser.add_argument("--checkhash", type=str2bool, nargs='?',
-                        const=True, default=True, metavar="yes|no",
-                        help="also check static files on the server")
-parser.add_argument("--logfile", help="file to write the non-error logs")
-
-args = parser.parse_args()
-
-# Set logfile; check permissions
-if args.logfile:
-    log_file = open(args.logfile, "a")
-
-# Build list of uuids
-if args.uuid:
-    uuids = [ args.uuid ]
-else:
-    assert (args.uuidfile)
-    uuids = [ ]
-    with open(args.uuidfile, "r") as file:
-        for line in file:
-            uuids.append(line.rstrip())
+# Options shared with fleet_monitor.py, which adds its own way to get
+# the list of elections
+def make_parser(description):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--url", required=True, help="prefix url (without trailing /elections )")
+    parser.add_argument("--wdir", required=True, help="work dir where logs are kept")
+    parser.add_argument("--checkhash", type=str2bool, nargs='?',
+                            const=True, default=True, metavar="yes|no",
+                            help="also check static files on the server")
+    parser.add_argument("--logfile", help="file to write the non-error logs")
+    parser.add_argument("--incremental", type=str2bool, nargs='?',
+                            const=True, default=False, metavar="yes|no",
+                            help="only download the audit files that changed since the previous run, and only the new part of ballots.jsons")
+    parser.add_argument("--bundle", type=str2bool, nargs='?',
+                            const=True, default=False, metavar="yes|no",
+                            help="download the public files of an election in a single archive (audit.tar.gz), when the server provides it")
+    parser.add_argument("--stream", type=str2bool, nargs='?',
+                            const=True, default=False, metavar="yes|no",
+                            help="write the audit files to disk while they are downloaded, instead of keeping them in memory")
+    parser.add_argument("--ballot-index", type=str2bool, nargs='?',
+                            const=True, default=False, metavar="yes|no",
+                            help="keep an index of the hashes of the ballots, so that only new ballots are hashed")
+    parser.add_argument("--archive", choices=['git', 'git-fast-import', 'chunks'],
+                            default='git',
+                            help="how snapshots are recorded: in the git repository of each election with git add and git commit, or with a single git fast-import; or in a store of deduplicated chunks (see chunk_store.py)")
+    parser.add_argument("--gc-packs", type=int, default=20, metavar="N",
+                            help="run git gc on an election once its repository has N packs (0: never)")
+    parser.add_argument("--max-connections", type=int, default=4, metavar="N",
+                            help="maximum number of simultaneous connections to the server")
+    parser.add_argument("--metrics-jsonl", metavar="FILE",
+                            help="append the metrics of each stage of each election to this file, as JSON lines")
+    parser.add_argument("--metrics-prom", metavar="FILE",
+                            help="write the latest metrics to this file, for the textfile collector of Prometheus")
+    parser.add_argument("--daemon", action="store_true",
+                            help="run forever, polling each election at a rate depending on its activity")
+    parser.add_argument("--min-interval", type=int, default=300, metavar="SECONDS",
+                            help="in daemon mode, delay between polls of an active election")
+    parser.add_argument("--max-interval", type=int, default=86400, metavar="SECONDS",
+                            help="in daemon mode, maximum delay between polls of an inactive election")
+    parser.add_argument("--jobs", type=int, default=1, metavar="N",
+                            help="number of elections downloaded concurrently")
+    parser.add_argument("--verify-jobs", type=int, default=os.cpu_count(), metavar="N",
+                            help="number of elections verified concurrently (default: number of cores)")
+    parser.add_argument("--python-verify", type=str2bool, nargs='?',
+                            const=True, default=False, metavar="yes|no",
+                            help="during the voting phase, check only the new ballots, in Python (see ballot_verifier.py), instead of running belenios-tool verify and verify-diff")
+    parser.add_argument("--ballot-jobs", type=int, default=os.cpu_count(), metavar="N",
+                            help="number of processes checking the ballots with --python-verify, shared among the elections verified concurrently (default: number of cores)")
+    return parser
 
-# check that wdir exists and is r/w
-if not os.path.isdir(args.wdir) or not os.access(args.wdir, os.W_OK | os.R_OK):
-    print("The wdir {} should read/write accessible".format(args.wdir))
-    sys.exit(1)
+# Check the options, and set the log file, the HTTP pool and the output
+# of the metrics
+def setup(args):
+    global log_file, pool, metrics_sink
 
-logme("[{}] Starting monitoring elections.".format(datetime.datetime.now()))
+    # Set logfile; check permissions
+    if args.logfile:
+        log_file = open(args.logfile, "a")
 
-for uuid in uuids:
-    logme("Start monitoring election {}".format(uuid))
+    # check that wdir exists and is r/w
+    if not os.path.isdir(args.wdir) or not os.access(args.wdir, os.W_OK | os.R_OK):
+        print("The wdir {} should read/write accessible".format(args.wdir))
+        sys.exit(1)
 
-    check_or_create_dir(args.wdir, uuid)
+    if (args.jobs < 1 or args.verify_jobs < 1 or args.ballot_jobs < 1
+            or args.max_connections < 1):
+        print("The number of jobs and of connections should be at least 1")
+        sys.exit(1)
 
-    status, data = download_audit_data(args.url.strip("/"), uuid)
+    # each request is logged with its timing
+    pool = http_pool.ConnectionPool(per_host=args.max_connections,
+            log=lambda s: logme("  " + s), observe=count_bytes)
 
-    # if we managed to download stuff, then check what we can
-    if not status.fail:
-        stat = write_and_verify_new_data(args.wdir, uuid, data)
-        status.merge(stat)
+    if args.metrics_jsonl or args.metrics_prom:
+        metrics_sink = MetricsSink(args.metrics_jsonl, args.metrics_prom)
 
-        stat = check_hash_ballots(data)
-        status.merge(stat)
+    if args.min_interval < 1 or args.max_interval < args.min_interval:
+        print("The intervals should satisfy 1 <= min-interval <= max-interval")
+        sys.exit(1)
 
-        stat = check_index_html(data)
-        status.merge(stat)
+def main():
+    parser = make_parser("monitor Belenios elections")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--uuidfile", help="file containing uuid's of election to monitor")
+    group.add_argument("--uuid", help="uuid of an election to monitor")
+    group.add_argument("--uuidcommand", help="command printing the uuid's of elections to monitor, e.g. \"list_live_elections.py /path/to/spool\"")
+    args = parser.parse_args()
+    setup(args)
 
-    # commit 
-    if status.msg != b'':
-        Elogme("Commit log for election {} is {}".format(uuid,
-            status.msg.decode()))
-    commit(args.wdir, uuid, status.msg)
-    
-# check hash of js files. They do not depend on a particular election, so
-# we dot it only once
+    logme("[{}] Starting monitoring elections.".format(datetime.datetime.now()))
 
-if args.checkhash == True:
-    hh = subprocess.run(["check_hash.py", "--url", args.url ],
-            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    if hh.returncode != 0:
-        print(hh.stdout.decode())
+    if args.daemon:
+        run_daemon(args)
+
+    # Build list of uuids
+    uuids = read_uuids(args)
+
+    failed = monitor_elections(args, uuids)
+
+    pool.close()
+    logme("HTTP: " + pool.report().splitlines()[-1])
+    if metrics_sink != None:
+        metrics_sink.write_prom()
+
+    # combined summary for all the monitored elections
+    if failed != []:
+        Elogme("{} election(s) out of {} failed: {}".format(len(failed),
+            len(uuids), " ".join(failed)))
+
+    # check hash of js files. They do not depend on a particular election, so
+    # we dot it only once
+
+    if args.checkhash == True:
+        if not check_static_files(args):
+            sys.exit(1)
+
+    if args.logfile:
+        log_file.close()
+
+    if failed != []:
         sys.exit(1)
-    else:
-        logme("Successfully checked hash of static files")
 
-if args.logfile:
-    log_file.close()
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,24 @@
 #!/usr/bin/env python3
 
 import smtplib
+import socket
+import ssl
 from email.mime.text import MIMEText
 from string import Template
 import time
 import getpass
+import argparse
+import os
+import sys
+import queue
+import random
+import threading
+import datetime
+import hashlib
+import re
+import mailbox
+import email.parser
+import concurrent.futures
 
 # In DEGUB mode, emails are sent to this address instead of the true one.
 # (typically the address of the credential authority)
@@ -17,9 +31,22 @@ SUBJECT='Élection du meilleur cookie: votre matériel de vote'
 UUID='7af1a378-ed25-481a-9775-7b1a7e55c746'
 
 # Your outgoing email configuration:
-SMTP='smtp.example.com'
-username='bozo'
-password = getpass.getpass("please type your password: ")
+SMTP='smtp.example.com' # host, or host:port
+username='bozo'         # None if the relay needs no authentication
+
+# Delivery: number of simultaneous SMTP sessions, and maximum number of
+# messages per second, in total and per session (None for no limit).
+# Adjust them to the policy of your relay.
+CONNECTIONS=4
+RATE=5
+RATE_PER_CONNECTION=None
+# After a temporary error (4xx reply, lost connection), a session waits
+# for a delay doubling from BACKOFF_MIN up to BACKOFF_MAX seconds before
+# reconnecting, and the message is put in a retry queue, which is sent
+# again once all the other messages are sent, at most MAX_ATTEMPTS times.
+MAX_ATTEMPTS=5
+BACKOFF_MIN=1
+BACKOFF_MAX=60
 
 # name of the file where to read the credentials
 CODE_FILE='codefile.txt'
@@ -71,24 +98,425 @@ Reminder: there are two candidates Maïté and Amandine.
 Thank you for your participation.
 """)
 
-# Real stuf starts here. Pretty short, isn't it?
-with open(CODE_FILE) as cf:
-    d = dict(UUID=UUID)
-    s = smtplib.SMTP(SMTP)
-    s.starttls()
-    s.login(username, password)
-    for line in cf:
-        l = line.split()
-        d['ELECTION_CODE']=l[1]
-        msg = MIMEText(TEMPLATE.substitute(d))
-        email=l[0].split(",")[0]
-        msg['Subject'] = SUBJECT
-        msg['From'] = FROM
-        if DEBUG:
-            msg['To'] = DEBUG_MAIL
-        else:
-            msg['To'] = email
-        s.send_message(msg)
-        time.sleep(0.2) # short delay; might need more for very large election
-    s.quit()
+# Real stuf starts here.
+
+def make_message(email, code):
+    d = dict(UUID=UUID, ELECTION_CODE=code)
+    msg = MIMEText(TEMPLATE.substitute(d))
+    msg['Subject'] = SUBJECT
+    msg['From'] = FROM
+    if DEBUG:
+        msg['To'] = DEBUG_MAIL
+    else:
+        msg['To'] = email
+    return msg
+
+# (key, email, credential) for each line of the code file, where key
+# identifies the line in the journal without revealing the credential
+def read_codes(code_file):
+    codes = []
+    with open(code_file) as cf:
+        for line in cf:
+            l = line.split()
+            if l == []:
+                continue
+            key = hashlib.sha256(line.strip().encode()).hexdigest()[:32]
+            codes.append((key, l[0].split(",")[0], l[1]))
+    return codes
+
+# Append-only journal of the delivered messages: a line "sent KEY EMAIL"
+# is written, and synced to disk, as soon as the relay accepted the
+# message for line KEY of the code file. After a crash, --resume skips
+# the lines in the journal, so that at most the messages being sent at
+# the time of the crash can be sent twice.
+class Journal:
+    def __init__(self, path):
+        self.sent = set()
+        complete = True
+        if os.path.exists(path):
+            with open(path, "r") as file:
+                for line in file:
+                    complete = line.endswith("\n")
+                    l = line.split()
+                    if complete and len(l) >= 2 and l[0] == "sent":
+                        self.sent.add(l[1])
+        self.file = open(path, "a")
+        if not complete:
+            # the last line was cut by a crash
+            self.file.write("\n")
+        self.lock = threading.Lock()
+
+    def add(self, key, email):
+        with self.lock:
+            self.file.write("sent {} {}\n".format(key, email))
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        self.file.close()
+
+# take() waits until sending one more message does not go over rate
+# messages per second, on average (with bursts of at most burst messages)
+class TokenBucket:
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        if self.rate == None:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst,
+                        self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+# Counters of the delivery, displayed on stderr while sending
+class Progress:
+    def __init__(self, total):
+        self.total = total
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.start = time.monotonic()
+        self.lock = threading.Lock()
+        self.stop = threading.Event()
+
+    def add(self, sent=0, failed=0, retries=0):
+        with self.lock:
+            self.sent += sent
+            self.failed += failed
+            self.retries += retries
+
+    def line(self):
+        with self.lock:
+            sent, failed, retries = self.sent, self.failed, self.retries
+        elapsed = time.monotonic() - self.start
+        rate = sent / elapsed if elapsed > 0 else 0
+        left = self.total - sent - failed
+        eta = "?"
+        if rate > 0:
+            eta = str(datetime.timedelta(seconds=round(left / rate)))
+        return "{}/{} sent, {} failed, {} retries, {:.1f} msg/s, ETA {}".format(
+                sent, self.total, failed, retries, rate, eta)
+
+    # on a terminal, the line is redrawn every second; otherwise, a
+    # line is printed every 30 seconds
+    def display(self):
+        tty = sys.stderr.isatty()
+        while not self.stop.wait(1 if tty else 30):
+            if tty:
+                print("\r" + self.line() + "\x1b[K", end="", file=sys.stderr,
+                        flush=True)
+            else:
+                print(self.line(), file=sys.stderr, flush=True)
+        print(("\r" if tty else "") + self.line(), file=sys.stderr, flush=True)
+
+# Temporary errors are 4xx replies and network errors. Other SMTP
+# errors (e.g. no STARTTLS or no suitable AUTH method) and TLS errors
+# come from the configuration, and are permanent; smtplib.SMTPException
+# being a subclass of OSError, they are ruled out first.
+def is_temporary(e):
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, _ in e.recipients.values())
+    if isinstance(e, smtplib.SMTPResponseException):
+        return 400 <= e.smtp_code < 500
+    if isinstance(e, (smtplib.SMTPServerDisconnected, socket.timeout,
+            ConnectionError)):
+        return True
+    if isinstance(e, (smtplib.SMTPException, ssl.SSLError)):
+        return False
+    return isinstance(e, OSError)
+
+def send_code(s, item):
+    key, email, code = item
+    s.send_message(make_message(email, code))
+
+# Two-phase mode: the messages are first rendered by a pool of processes
+# into a spool, a Maildir directory or an mbox file (--render), which
+# can be inspected, or handed to a local MTA; then they are sent from
+# there (--send). The key of the line of each message is kept in the
+# header KEY_HEADER for the journal, and removed before sending.
+KEY_HEADER = 'X-Belenios-Credential-Key'
+
+def render(item):
+    key, email, code = item
+    msg = make_message(email, code)
+    msg[KEY_HEADER] = key
+    return msg.as_bytes()
+
+def open_spool(path, spool_format, create=False):
+    if spool_format == 'mbox':
+        return mailbox.mbox(path, create=create)
+    return mailbox.Maildir(path, factory=None, create=create)
+
+# The spool holds the credentials in clear, so it is only readable by
+# its owner (the umask also applies to the rendering processes)
+def render_spool(codes, path, spool_format, jobs):
+    umask = os.umask(0o077)
+    try:
+        write_spool(codes, path, spool_format, jobs)
+    finally:
+        os.umask(umask)
+
+def write_spool(codes, path, spool_format, jobs):
+    box = open_spool(path, spool_format, True)
+    box.lock()
+    try:
+        with concurrent.futures.ProcessPoolExecutor(jobs) as ex:
+            for data in ex.map(render, codes, chunksize=256):
+                box.add(data)
+        box.flush()
+    finally:
+        box.unlock()
+        box.close()
+
+# (key, email, key in the spool) of each message of the spool; raise
+# ValueError if one was not written by render_spool
+def read_spool(box):
+    parser = email.parser.BytesHeaderParser()
+    items = []
+    for k in box.iterkeys():
+        msg = parser.parsebytes(box.get_bytes(k))
+        if msg[KEY_HEADER] == None or msg['To'] == None:
+            raise ValueError("message {} has no {} or To header".format(k,
+                KEY_HEADER))
+        items.append((msg[KEY_HEADER], msg['To'], k))
+    return items
+
+# Send function of deliver for the items of read_spool
+def spool_sender(box):
+    lock = threading.Lock()
+    key_header = re.compile(r'^{}:.*\n'.format(KEY_HEADER).encode(),
+            re.IGNORECASE | re.MULTILINE)
+    def send(s, item):
+        key, email, k = item
+        with lock:
+            data = box.get_bytes(k)
+        end = data.find(b'\n\n')
+        data = key_header.sub(b'', data[:end+1]) + data[end+1:]
+        s.sendmail(FROM, [email], re.sub(rb'\r?\n', b'\r\n', data))
+    return send
+
+# Send a message for each (key, email, data) of codes, over
+# config.connections concurrent sessions, recording them in journal (if
+# not None); return the list of emails that could not be sent to. The
+# messages are sent by send(session, item): by default, data is the
+# credential, and the message is made from the template. A permanent
+# error while opening a session (e.g. a wrong password) stops the
+# delivery, and is raised.
+def deliver(codes, config, password, journal=None, send=send_code):
+    rate = TokenBucket(config.rate)
+    progress = Progress(len(codes))
+    failed = []
+    lock = threading.Lock()
+    stop = threading.Event()
+    fatal = []
+
+    def connect():
+        s = smtplib.SMTP(config.smtp, timeout=60)
+        try:
+            s.starttls()
+            if config.username != None:
+                s.login(config.username, password)
+        except:
+            s.close()
+            raise
+        return s
+
+    # Send the messages of todo; those getting temporary errors are
+    # added to retry
+    def worker(todo, retry, last):
+        rate_conn = TokenBucket(config.rate_per_connection)
+        s = None
+        delay = BACKOFF_MIN
+        while not stop.is_set():
+            try:
+                item = todo.get_nowait()
+            except queue.Empty:
+                break
+            key, email = item[0], item[1]
+            connecting = s == None
+            try:
+                if connecting:
+                    # opening a session counts as a message, so that
+                    # failing ones do not hammer the relay
+                    rate.take()
+                    s = connect()
+                    connecting = False
+                rate.take()
+                rate_conn.take()
+                send(s, item)
+                if journal != None:
+                    journal.add(key, email)
+                progress.add(sent=1)
+                delay = BACKOFF_MIN
+            except (smtplib.SMTPException, OSError) as e:
+                if connecting and not is_temporary(e):
+                    with lock:
+                        fatal.append(e)
+                    stop.set()
+                    break
+                if not is_temporary(e) or last:
+                    print("\nFailed to send to {}: {}".format(email, e),
+                            file=sys.stderr)
+                    progress.add(failed=1)
+                    with lock:
+                        failed.append(email)
+                    continue
+                with lock:
+                    retry.append(item)
+                progress.add(retries=1)
+                # start again on a new session, after a while
+                if s != None:
+                    s.close()
+                    s = None
+                stop.wait(delay * random.uniform(1, 1.5))
+                delay = min(2 * delay, BACKOFF_MAX)
+        if s != None:
+            try:
+                s.quit()
+            except (smtplib.SMTPException, OSError):
+                s.close()
+
+    display = threading.Thread(target=progress.display)
+    display.start()
+    workers = []
+    try:
+        pending = codes
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            if pending == []:
+                break
+            if attempt > 1:
+                print("\nRetrying {} message(s) after temporary errors".format(
+                    len(pending)), file=sys.stderr)
+            todo = queue.Queue()
+            for item in pending:
+                todo.put(item)
+            retry = []
+            last = attempt == MAX_ATTEMPTS
+            workers = [ threading.Thread(target=worker,
+                args=(todo, retry, last))
+                for i in range(min(config.connections, len(pending))) ]
+            for t in workers:
+                t.start()
+            for t in workers:
+                t.join()
+            if fatal != []:
+                break
+            pending = retry
+    finally:
+        # on Ctrl-C, let the messages being sent finish
+        stop.set()
+        for t in workers:
+            t.join()
+        progress.stop.set()
+        display.join()
+    if fatal != []:
+        raise fatal[0]
+    return failed
+
+def main():
+    parser = argparse.ArgumentParser(description="send the credentials of an election by email (edit the parameters at the beginning of this script)")
+    parser.add_argument("--code-file", default=CODE_FILE,
+            help="file of the credentials (default: {})".format(CODE_FILE))
+    parser.add_argument("--smtp", default=SMTP, metavar="HOST[:PORT]",
+            help="outgoing SMTP server (default: {})".format(SMTP))
+    parser.add_argument("--username", default=username,
+            help="login on the SMTP server (default: {}); the password is asked, or read from the environment variable SMTP_PASSWORD".format(username))
+    parser.add_argument("--connections", type=int, default=CONNECTIONS,
+            metavar="N", help="number of simultaneous SMTP sessions (default: {})".format(CONNECTIONS))
+    parser.add_argument("--rate", type=float, default=RATE, metavar="N",
+            help="maximum number of messages per second (default: {}; 0 for no limit)".format(RATE))
+    parser.add_argument("--rate-per-connection", type=float,
+            default=RATE_PER_CONNECTION, metavar="N",
+            help="maximum number of messages per second and per session (default: {}; 0 for no limit)".format(RATE_PER_CONNECTION))
+    parser.add_argument("--journal", metavar="FILE",
+            help="journal of the delivered messages (default: the code file followed by .journal)")
+    parser.add_argument("--resume", action="store_true",
+            help="do not send again the messages recorded in the journal, e.g. after a crash")
+    parser.add_argument("--render", metavar="SPOOL",
+            help="only write the messages in SPOOL, to send them later with --send")
+    parser.add_argument("--send", metavar="SPOOL",
+            help="send the messages written in SPOOL by --render, instead of the code file")
+    parser.add_argument("--spool-format", choices=['maildir', 'mbox'],
+            default='maildir', help="format of the spool (default: maildir)")
+    parser.add_argument("--render-jobs", type=int, default=os.cpu_count(),
+            metavar="N", help="number of processes rendering the messages (default: number of cores)")
+    config = parser.parse_args()
+    if config.connections < 1:
+        print("The number of connections should be at least 1")
+        sys.exit(1)
+    if config.rate == 0:
+        config.rate = None
+    if config.rate_per_connection == 0:
+        config.rate_per_connection = None
+
+    if config.render:
+        if os.path.exists(config.render):
+            print("The spool {} already exists".format(config.render))
+            sys.exit(1)
+        start = time.monotonic()
+        codes = read_codes(config.code_file)
+        render_spool(codes, config.render, config.spool_format,
+                max(config.render_jobs, 1))
+        print("Wrote {} message(s) in {} in {:.1f}s".format(len(codes),
+            config.render, time.monotonic() - start), file=sys.stderr)
+        return
+
+    password = None
+    if config.username != None:
+        password = os.environ.get("SMTP_PASSWORD")
+        if password == None:
+            password = getpass.getpass("please type your password: ")
+
+    send = send_code
+    if config.send:
+        box = open_spool(config.send, config.spool_format)
+        try:
+            codes = read_spool(box)
+        except ValueError as e:
+            print("The spool {} was not written by --render: {}".format(
+                config.send, e))
+            sys.exit(1)
+        send = spool_sender(box)
+        journal_file = config.journal or config.send.rstrip("/") + ".journal"
+    else:
+        codes = read_codes(config.code_file)
+        journal_file = config.journal or config.code_file + ".journal"
+    if os.path.exists(journal_file) and not config.resume:
+        print("The journal {} already exists: use --resume to skip the messages already sent, or remove it".format(journal_file))
+        sys.exit(1)
+    journal = Journal(journal_file)
+    if config.resume:
+        n = len(codes)
+        codes = [ x for x in codes if x[0] not in journal.sent ]
+        print("Resuming: {} message(s) already sent, {} to send".format(
+            n - len(codes), len(codes)), file=sys.stderr)
+    try:
+        failed = deliver(codes, config, password, journal, send)
+    except KeyboardInterrupt:
+        print("\nInterrupted; run again with --resume to send the remaining messages", file=sys.stderr)
+        sys.exit(130)
+    except (smtplib.SMTPException, OSError) as e:
+        print("\nCould not open a session on {}: {}; run again with --resume once fixed".format(
+            config.smtp, e), file=sys.stderr)
+        sys.exit(1)
+    finally:
+        journal.close()
+    if failed != []:
+        print("Could not send to {} address(es): {}".format(len(failed),
+            " ".join(failed)), file=sys.stderr)
+        sys.exit(1)
 
+if __name__ == "__main__":
+    main()
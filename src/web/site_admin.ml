@@ -211,7 +211,8 @@ let validate_election uuid se =
   (* finish *)
   let%lwt () = Web_persist.set_election_state uuid `Open in
   let%lwt dates = Web_persist.get_election_dates uuid in
-  Web_persist.set_election_dates uuid {dates with e_finalization = Some (now ())}
+  let%lwt () = Web_persist.set_election_dates uuid {dates with e_finalization = Some (now ())} in
+  Web_persist.add_registry_event uuid `Validated
 
 let delete_sensitive_data uuid =
   let uuid_s = raw_string_of_uuid uuid in
@@ -228,7 +229,8 @@ let delete_sensitive_data uuid =
 let archive_election uuid =
   let%lwt () = delete_sensitive_data uuid in
   let%lwt dates = Web_persist.get_election_dates uuid in
-  Web_persist.set_election_dates uuid {dates with e_archive = Some (now ())}
+  let%lwt () = Web_persist.set_election_dates uuid {dates with e_archive = Some (now ())} in
+  Web_persist.add_registry_event uuid `Archived
 
 let delete_election uuid =
   let uuid_s = raw_string_of_uuid uuid in
@@ -300,6 +302,7 @@ let delete_election uuid =
     }
   in
   let%lwt () = write_file ~uuid "deleted.json" [string_of_deleted_election de] in
+  let%lwt () = Web_persist.add_registry_event uuid `Deleted in
   let files_to_delete = [
       "election.json";
       "ballots.jsons";
@@ -316,6 +319,7 @@ let delete_election uuid =
       "shuffles.jsons";
       "voters.txt";
       "archive.zip";
+      "audit.tar.gz";
       "audit_cache.json";
     ]
   in
@@ -1201,7 +1205,8 @@ let () =
     )
 
 let destroy_election uuid =
-  rmdir (!Web_config.spool_dir / raw_string_of_uuid uuid)
+  let%lwt () = rmdir (!Web_config.spool_dir / raw_string_of_uuid uuid) in
+  Web_persist.add_registry_event uuid `Deleted
 
 let () =
   Any.register ~service:election_draft_destroy
@@ -1636,13 +1641,6 @@ let () =
            String.send (string_of_raw_result full.(index), "application/json")
     )
 
-let copy_file src dst =
-  let open Lwt_io in
-  chars_of_file src |> chars_to_file dst
-
-let try_copy_file src dst =
-  if%lwt file_exists src then copy_file src dst else return_unit
-
 let make_archive uuid =
   let uuid_s = raw_string_of_uuid uuid in
   let%lwt temp_dir =
@@ -355,3 +355,108 @@ let () =
     (fun (uuid, f) () ->
      let%lwt site_user = Eliom_reference.get Web_state.site_user in
      handle_pseudo_file uuid f site_user)
+
+(* All the public files of an election in a single compressed archive,
+   for auditors who download them regularly. Besides the files, it
+   contains SHA256SUMS, with the digest of each of them (first, so that
+   it can be read before the files). The archive is kept in the spool,
+   and is rebuilt when one of the files is newer. Its modification time
+   is set to the one of the newest file, as seen before copying the
+   files, so that a file changed in the meantime makes it outdated. *)
+
+let audit_bundle_files = [ESRaw; ESTrustees; ESCreds; ESBallots; ESResult; ESShuffles]
+
+let get_mtime fname =
+  match%lwt Lwt_unix.stat fname with
+  | st -> return_some st.Unix.st_mtime
+  | exception _ -> return_none
+
+let build_audit_bundle uuid =
+  let dir = !Web_config.spool_dir / raw_string_of_uuid uuid in
+  let files = List.map string_of_election_file audit_bundle_files in
+  let%lwt mtimes = Lwt_list.map_p (fun x -> get_mtime (dir / x)) files in
+  let newest =
+    List.fold_left (fun accu x ->
+        match x with
+        | Some t -> max accu t
+        | None -> accu
+      ) 0. mtimes
+  in
+  let fname = dir / "audit.tar.gz" in
+  match%lwt get_mtime fname with
+  | Some t when t >= newest -> return_true
+  | _ ->
+     let%lwt temp_dir, fname_new =
+       Lwt_preemptive.detach (fun () ->
+           let temp_dir = Filename.temp_file "belenios" "audit" in
+           Sys.remove temp_dir;
+           Unix.mkdir temp_dir 0o700;
+           temp_dir, Filename.temp_file ~temp_dir:dir "audit" ".tar.gz.new"
+         ) ()
+     in
+     Lwt.finalize
+       (fun () ->
+         let%lwt () =
+           Lwt_list.iter_p (fun x -> try_copy_file (dir / x) (temp_dir / x)) files
+         in
+         let%lwt present = Lwt_list.filter_p (fun x -> file_exists (temp_dir / x)) files in
+         let present = String.concat " " present in
+         let command =
+           Printf.ksprintf Lwt_process.shell
+             "cd \"%s\" && sha256sum %s > SHA256SUMS && tar -czf audit.tar.gz SHA256SUMS %s"
+             temp_dir present present
+         in
+         let%lwt r = Lwt_process.exec command in
+         match r with
+         | Unix.WEXITED 0 ->
+            let%lwt () = copy_file (temp_dir / "audit.tar.gz") fname_new in
+            let%lwt () = Lwt_unix.utimes fname_new newest newest in
+            let%lwt () = Lwt_unix.rename fname_new fname in
+            return_true
+         | _ ->
+            Printf.ksprintf Ocsigen_messages.errlog
+              "Error while creating audit.tar.gz for election %s"
+              (raw_string_of_uuid uuid);
+            return_false
+       )
+       (fun () ->
+         let%lwt () = cleanup_file fname_new in
+         rmdir temp_dir
+       )
+
+(* Builds in progress, by election: concurrent requests wait for the
+   same build instead of starting their own. *)
+let audit_bundle_builds = ref SMap.empty
+
+let make_audit_bundle uuid =
+  let uuid_s = raw_string_of_uuid uuid in
+  match SMap.find_opt uuid_s !audit_bundle_builds with
+  | Some t -> Lwt.protected t
+  | None ->
+     let t = build_audit_bundle uuid in
+     (match Lwt.state t with
+      | Lwt.Sleep ->
+         audit_bundle_builds := SMap.add uuid_s t !audit_bundle_builds;
+         Lwt.on_termination t (fun () ->
+             audit_bundle_builds := SMap.remove uuid_s !audit_bundle_builds
+           )
+      | Lwt.Return _ | Lwt.Fail _ -> ()
+     );
+     Lwt.protected t
+
+let () =
+  Any.register ~service:election_audit_bundle
+    (fun (uuid, ()) () ->
+      let%lwt election = Web_persist.get_raw_election uuid in
+      match election with
+      | None -> election_not_found ()
+      | Some _ ->
+         (* the result is confidential while it is hidden *)
+         match%lwt Web_persist.get_election_result_hidden uuid with
+         | Some _ -> forbidden ()
+         | None ->
+            if%lwt make_audit_bundle uuid then
+              File.send ~content_type:"application/gzip"
+                (!Web_config.spool_dir / raw_string_of_uuid uuid / "audit.tar.gz")
+            else fail_http 500
+    )
@@ -371,6 +371,13 @@ let rmdir dir =
   let%lwt _ = Lwt_process.exec command in
   return_unit
 
+let copy_file src dst =
+  let open Lwt_io in
+  chars_of_file src |> chars_to_file dst
+
+let try_copy_file src dst =
+  if%lwt file_exists src then copy_file src dst else return_unit
+
 let urlize = String.map (function '+' -> '-' | '/' -> '_' | c -> c)
 let unurlize = String.map (function '-' -> '+' | '_' -> '/' | c -> c)
 
@@ -145,6 +145,8 @@ val write_file : ?uuid:uuid -> string -> string list -> unit Lwt.t
 
 val cleanup_file : string -> unit Lwt.t
 val rmdir : string -> unit Lwt.t
+val copy_file : string -> string -> unit Lwt.t
+val try_copy_file : string -> string -> unit Lwt.t
 
 val urlize : string -> string
 val unurlize : string -> string
@@ -33,13 +33,58 @@ open Web_common
 
 let ( / ) = Filename.concat
 
+(* Append-only registry of the elections, in the root of the spool: one
+   JSON line for each step of the life of an election, so that tools
+   can know the state of all elections with a single read, instead of
+   reading files in the directory of each election. *)
+
+let registry_mutex = Lwt_mutex.create ()
+
+let registry_entry uuid event = {
+    re_uuid = uuid;
+    re_event = event;
+    re_date = now ();
+    re_owner = None;
+    re_name = None;
+    re_nb_voters = None;
+    re_cred_authority = None;
+    re_trustees = None;
+    re_server_is_trustee = None;
+  }
+
+let append_to_registry entry =
+  let fname = !Web_config.spool_dir / "registry.jsons" in
+  try%lwt
+    Lwt_mutex.with_lock registry_mutex
+      (fun () ->
+        Lwt_io.with_file
+          ~flags:(Unix.([O_WRONLY; O_APPEND; O_CREAT]))
+          ~perm:0o600 ~mode:Lwt_io.Output fname
+          (fun oc -> Lwt_io.write_line oc (string_of_registry_entry entry))
+      )
+  with e ->
+    Printf.ksprintf Ocsigen_messages.errlog
+      "Error while writing to the registry of elections: %s"
+      (Printexc.to_string e);
+    return_unit
+
 let get_draft_election uuid =
   match%lwt read_file ~uuid "draft.json" with
   | Some [x] -> return_some (draft_election_of_string x)
   | _ -> return_none
 
 let set_draft_election uuid se =
-  write_file ~uuid "draft.json" [string_of_draft_election se]
+  let%lwt exists =
+    file_exists (!Web_config.spool_dir / raw_string_of_uuid uuid / "draft.json")
+  in
+  let%lwt () = write_file ~uuid "draft.json" [string_of_draft_election se] in
+  if exists then return_unit
+  else
+    append_to_registry {
+        (registry_entry uuid `Created) with
+        re_owner = Some se.se_owner;
+        re_name = Some se.se_questions.t_name;
+      }
 
 let get_election_result uuid =
   match%lwt read_file ~uuid "result.json" with
@@ -82,12 +127,27 @@ let set_election_dates uuid dates =
   write_file ~uuid "dates.json" [string_of_election_dates dates]
 
 let set_election_state uuid s =
-  match s with
-  | `Archived ->
-     (try%lwt Lwt_unix.unlink (!Web_config.spool_dir / raw_string_of_uuid uuid / "state.json") with
-      | _ -> return_unit
-     )
-  | _ -> write_file ~uuid "state.json" [string_of_election_state s]
+  let fname = !Web_config.spool_dir / raw_string_of_uuid uuid / "state.json" in
+  (* the first opening of an election is its validation, registered by
+     the caller with more details *)
+  let%lwt event =
+    match s with
+    | `Open -> if%lwt file_exists fname then return_some `Opened else return_none
+    | `Closed -> return_some `Closed
+    | `Tallied -> return_some `Tallied
+    | `Shuffling | `EncryptedTally _ | `Archived -> return_none
+  in
+  let%lwt () =
+    match s with
+    | `Archived ->
+       (try%lwt Lwt_unix.unlink fname with
+        | _ -> return_unit
+       )
+    | _ -> write_file ~uuid "state.json" [string_of_election_state s]
+  in
+  match event with
+  | Some e -> append_to_registry (registry_entry uuid e)
+  | None -> return_unit
 
 let get_election_state uuid =
   match%lwt read_file ~uuid "state.json" with
@@ -210,6 +270,32 @@ let get_elections_by_owner user =
 let get_voters uuid =
   read_file ~uuid "voters.txt"
 
+let add_registry_event uuid event =
+  let entry = registry_entry uuid event in
+  match event with
+  | `Validated ->
+     let%lwt metadata = get_election_metadata uuid in
+     let%lwt name =
+       match%lwt get_raw_election uuid with
+       | Some x -> return_some (Election.of_string x).e_params.e_name
+       | None -> return_none
+     in
+     let%lwt nb_voters =
+       match%lwt get_voters uuid with
+       | Some x -> return_some (List.length x)
+       | None -> return_none
+     in
+     append_to_registry {
+         entry with
+         re_owner = metadata.e_owner;
+         re_name = name;
+         re_nb_voters = nb_voters;
+         re_cred_authority = metadata.e_cred_authority;
+         re_trustees = metadata.e_trustees;
+         re_server_is_trustee = metadata.e_server_is_trustee;
+       }
+  | _ -> append_to_registry entry
+
 let get_passwords uuid =
   let csv =
     try Some (Csv.load (!Web_config.spool_dir / raw_string_of_uuid uuid / "passwords.csv"))
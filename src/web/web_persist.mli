@@ -55,6 +55,8 @@ type election_kind =
   ]
 val get_elections_by_owner : user -> (election_kind * uuid * datetime * string) list Lwt.t
 
+val add_registry_event : uuid -> registry_event -> unit Lwt.t
+
 val get_voters : uuid -> string list option Lwt.t
 val get_passwords : uuid -> (string * string) SMap.t option Lwt.t
 val get_private_key : uuid -> number option Lwt.t
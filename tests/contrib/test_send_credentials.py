@@ -0,0 +1,74 @@
+#!/usr/bin/python
+# coding: utf-8
+import unittest
+import os
+import sys
+import ssl
+import socket
+import smtplib
+import argparse
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "contrib"))
+import send_credentials
+import bench_send_credentials
+
+
+# A relay that does not offer STARTTLS
+class NoStartTLSSession(bench_send_credentials.SMTPSession):
+    def reply(self, line):
+        if line == "250 STARTTLS":
+            line = "250 HELP"
+        super().reply(line)
+
+
+class TestIsTemporary(unittest.TestCase):
+    def test_temporary(self):
+        for e in [smtplib.SMTPResponseException(451, b"try again later"),
+                  smtplib.SMTPRecipientsRefused({"a@example.com": (450, b"greylisted")}),
+                  smtplib.SMTPServerDisconnected("Connection unexpectedly closed"),
+                  socket.timeout("timed out"),
+                  ConnectionRefusedError(111, "Connection refused")]:
+            self.assertTrue(send_credentials.is_temporary(e), repr(e))
+
+    def test_permanent(self):
+        for e in [smtplib.SMTPAuthenticationError(535, b"bad credentials"),
+                  smtplib.SMTPRecipientsRefused({"a@example.com": (550, b"no such user")}),
+                  smtplib.SMTPNotSupportedError("STARTTLS extension not supported by server."),
+                  smtplib.SMTPException("No suitable authentication method found."),
+                  ssl.SSLCertVerificationError("certificate verify failed")]:
+            self.assertFalse(send_credentials.is_temporary(e), repr(e))
+
+
+class TestMisconfiguredRelay(unittest.TestCase):
+    def setUp(self):
+        self.sink = bench_send_credentials.SMTPSink(("127.0.0.1", 0), None)
+        self.sink.RequestHandlerClass = NoStartTLSSession
+        threading.Thread(target=self.sink.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.sink.shutdown()
+        self.sink.server_close()
+
+    def test_no_starttls_stops_delivery(self):
+        with tempfile.TemporaryDirectory() as d:
+            code_file = os.path.join(d, "codes.txt")
+            bench_send_credentials.write_code_file(code_file, 50)
+            codes = send_credentials.read_codes(code_file)
+        config = argparse.Namespace(
+            smtp="127.0.0.1:{}".format(self.sink.server_address[1]),
+            username="bench", connections=2, rate=None,
+            rate_per_connection=None)
+        start = time.monotonic()
+        with self.assertRaises(smtplib.SMTPNotSupportedError):
+            send_credentials.deliver(codes, config, "bench")
+        # no retry rounds with backoff, and one session per worker
+        self.assertLess(time.monotonic() - start, send_credentials.BACKOFF_MIN)
+        self.assertLessEqual(self.sink.sessions, 2)
+        self.assertEqual(self.sink.received, {})
+
+
+if __name__ == "__main__":
+    unittest.main()